@@ -13,12 +13,1123 @@ Created on Thu Mar 12 14:22:47 2020
 
 
 from torchvision import transforms, datasets
+import io
+import itertools
+import copy
 import os
+import json
+import math
+import random
+import tarfile
+import numpy as np
+import PIL.Image as pil
 import torch
+import torch.nn.functional as F
+from mpi4py import MPI
+from utils import get_node_comm, cores_per_rank
 
 
-def mnist_data(rand_rotation=False, max_degree=90):
-    if rand_rotation == True:
+def dataset_labels(dataset):
+    '''
+    Labels of all the samples in the dataset, read from the dataset metadata
+    so that no image is decoded or transformed
+    '''
+    if isinstance(dataset, torch.utils.data.Subset):
+        return dataset_labels(dataset.dataset)[dataset.indices]
+    if isinstance(dataset, torch.utils.data.ConcatDataset):
+        return torch.cat([dataset_labels(d) for d in dataset.datasets])
+    if hasattr(dataset, 'targets'):
+        return torch.as_tensor(dataset.targets, dtype=torch.long)
+    if hasattr(dataset, 'samples'):
+        return torch.tensor(
+            [target for _, target in dataset.samples], dtype=torch.long
+        )
+    # no metadata available: fall back to reading every sample
+    return torch.tensor(
+        [int(dataset[index][1]) for index in range(len(dataset))],
+        dtype=torch.long,
+    )
+
+
+def label_subset(dataset, label):
+    '''
+    Lazy view of the samples of the dataset with the given label
+    '''
+    if hasattr(dataset, 'label_subset'):
+        return dataset.label_subset(label)
+    indices = torch.nonzero(dataset_labels(dataset) == int(label))
+    return torch.utils.data.Subset(dataset, indices.view(-1).tolist())
+
+
+def shard_subset(dataset, index, count):
+    '''
+    Lazy view of the index-th of count disjoint shards of the dataset.
+    The shards have the same length, the remaining samples are dropped, so
+    that the ranks sharing a label run the same number of steps.
+    '''
+    if count == 1:
+        return dataset
+    if hasattr(dataset, 'shard'):
+        return dataset.shard(index, count)
+    length = len(dataset) // count * count
+    return torch.utils.data.Subset(dataset, range(index, length, count))
+
+
+def class_sample_counts(dataset, n_classes):
+    '''
+    Number of samples of each class of the dataset, read from the dataset
+    metadata, or from the index of the tar files when streaming them
+    '''
+    if isinstance(dataset, TarShardDataset):
+        counts = np.zeros(n_classes, dtype=np.int64)
+        for shard in dataset.index.values():
+            counts[shard['label']] += shard['size']
+        return counts
+    return np.bincount(dataset_labels(dataset).numpy(), minlength=n_classes)
+
+
+# resolution of the images used for training
+resolutions = {'MNIST': 28, 'CIFAR10': 64, 'CIFAR100': 64, 'IMAGENET1K': 64}
+num_classes = {'MNIST': 10, 'CIFAR10': 10, 'CIFAR100': 100, 'IMAGENET1K': 1000}
+
+imagenet_path = '/Users/7ml/Documents/ImageNet1k/'
+
+
+def uint8_transform(resolution, center_crop=False):
+    '''
+    Per-sample transform producing uint8 image tensors at the given resolution
+    '''
+    steps = [transforms.Resize(resolution)]
+    if center_crop:
+        steps.append(transforms.CenterCrop(resolution))
+    steps.append(transforms.PILToTensor())
+    return transforms.Compose(steps)
+
+
+def download_once(make_dataset, reader=True):
+    '''
+    Dataset built by make_dataset(download) on the ranks for which reader is
+    True. The first rank builds it first and downloads the files if needed,
+    while the other ranks wait to open the downloaded files. Called by all
+    the ranks.
+    '''
+    comm = MPI.COMM_WORLD
+    dataset = None
+    if comm.Get_rank() == 0:
+        dataset = make_dataset(True)
+    comm.Barrier()
+    if comm.Get_rank() != 0 and reader:
+        dataset = make_dataset(False)
+    return dataset
+
+
+def uint8_data(dataset_name, download=True, native=False):
+    '''
+    Training set returning uint8 image tensors at the training resolution.
+    ImageNet images are center cropped. With native=True the images are left
+    at their original size.
+    '''
+    out_dir = '{}/dataset'.format(os.getcwd())
+    compose = uint8_transform(resolutions[dataset_name])
+    if native:
+        compose = transforms.PILToTensor()
+    if dataset_name == 'MNIST':
+        return datasets.MNIST(
+            root=out_dir, train=True, transform=compose, download=download
+        )
+    elif dataset_name == 'CIFAR10':
+        return datasets.CIFAR10(
+            root=out_dir, train=True, transform=compose, download=download
+        )
+    elif dataset_name == 'CIFAR100':
+        return datasets.CIFAR100(
+            root=out_dir, train=True, transform=compose, download=download
+        )
+    elif dataset_name == 'IMAGENET1K':
+        if not native:
+            compose = uint8_transform(
+                resolutions[dataset_name], center_crop=True
+            )
+        return datasets.ImageFolder(
+            os.path.join(imagenet_path, "train"), compose
+        )
+    raise RuntimeError('Dataset not recognized')
+
+
+def uint8_augmentation(dataset_name):
+    '''
+    Random transform applied to the pre-decoded images of a dataset in place
+    of its random PIL transform. The ImageNet random crop is taken from the
+    stored center crop.
+    '''
+    if dataset_name == 'IMAGENET1K':
+        return transforms.RandomResizedCrop(resolutions[dataset_name])
+    return None
+
+
+class BatchTransform(object):
+    '''
+    Transform of a whole collated batch of uint8 images of shape
+    (B, C, H, W): random resized crop or resize to the training resolution,
+    random rotation and normalization to [-1, 1]
+    '''
+
+    def __init__(
+        self,
+        resolution,
+        max_degree=None,
+        random_resized_crop=False,
+        scale=(0.08, 1.0),
+        ratio=(3.0 / 4.0, 4.0 / 3.0),
+    ):
+        self.resolution = resolution
+        self.max_degree = max_degree
+        self.random_resized_crop = random_resized_crop
+        self.scale = scale
+        self.ratio = ratio
+
+    def __call__(self, images):
+        images = images.float()
+        if self.random_resized_crop:
+            images = self.resized_crop(images)
+        else:
+            images = self.resize(images)
+        if self.max_degree is not None:
+            images = self.rotate(images)
+        return images.div_(127.5).sub_(1.0)
+
+    def resize(self, images):
+        # the shorter side is matched to the resolution as in Resize
+        height, width = images.shape[-2:]
+        if min(height, width) == self.resolution:
+            return images
+        if height <= width:
+            size = (self.resolution, self.resolution * width // height)
+        else:
+            size = (self.resolution * height // width, self.resolution)
+        return F.interpolate(
+            images,
+            size=size,
+            mode='bilinear',
+            align_corners=False,
+            antialias=True,
+        )
+
+    def resized_crop(self, images):
+        batch_size, channels, height, width = images.shape
+        area = images.new_empty(batch_size).uniform_(*self.scale)
+        log_ratio = images.new_empty(batch_size).uniform_(
+            math.log(self.ratio[0]), math.log(self.ratio[1])
+        )
+        aspect_ratio = torch.exp(log_ratio)
+        # crop sizes relative to the image size
+        crop_width = torch.sqrt(area * aspect_ratio).clamp_(max=1.0)
+        crop_height = torch.sqrt(area / aspect_ratio).clamp_(max=1.0)
+        center_x = (1.0 - crop_width) * (2.0 * torch.rand_like(area) - 1.0)
+        center_y = (1.0 - crop_height) * (2.0 * torch.rand_like(area) - 1.0)
+        zeros = torch.zeros_like(area)
+        theta = torch.stack(
+            [
+                torch.stack([crop_width, zeros, center_x], dim=1),
+                torch.stack([zeros, crop_height, center_y], dim=1),
+            ],
+            dim=1,
+        )
+        grid = F.affine_grid(
+            theta,
+            (batch_size, channels, self.resolution, self.resolution),
+            align_corners=False,
+        )
+        return F.grid_sample(
+            images, grid, mode='bilinear', align_corners=False
+        )
+
+    def rotate(self, images):
+        angle = images.new_empty(images.shape[0]).uniform_(
+            -math.radians(self.max_degree), math.radians(self.max_degree)
+        )
+        cos, sin, zeros = torch.cos(angle), torch.sin(angle), angle * 0.0
+        theta = torch.stack(
+            [
+                torch.stack([cos, -sin, zeros], dim=1),
+                torch.stack([sin, cos, zeros], dim=1),
+            ],
+            dim=1,
+        )
+        grid = F.affine_grid(theta, images.shape, align_corners=False)
+        # rotated-in pixels are black (zero before normalization)
+        return F.grid_sample(
+            images, grid, mode='bilinear', align_corners=False
+        )
+
+
+def dataset_batch_transform(dataset_name, rand_rotation=False, max_degree=90):
+    '''
+    Batched counterpart of the per-sample transforms of a dataset
+    '''
+    return BatchTransform(
+        resolutions[dataset_name],
+        max_degree=max_degree if rand_rotation else None,
+        random_resized_crop=dataset_name == 'IMAGENET1K',
+    )
+
+
+class BatchCollate(object):
+    '''
+    Collate function applying a batch transform to the collated images
+    '''
+
+    def __init__(self, batch_transform):
+        self.batch_transform = batch_transform
+
+    def __call__(self, samples):
+        images, labels = torch.utils.data.dataloader.default_collate(samples)
+        return self.batch_transform(images), labels
+
+
+def batch_transform_of(dataset):
+    '''
+    Batch transform attached to a dataset, or to the dataset it is a view of
+    '''
+    if isinstance(dataset, torch.utils.data.Subset):
+        return batch_transform_of(dataset.dataset)
+    if isinstance(dataset, torch.utils.data.ConcatDataset):
+        return batch_transform_of(dataset.datasets[0])
+    return getattr(dataset, 'batch_transform', None)
+
+
+def sample_shape(dataset):
+    '''
+    Shape of a training image, after the batch transform if there is one
+    '''
+    if getattr(dataset, 'image_shape', None) is not None:
+        image = torch.zeros(dataset.image_shape, dtype=torch.uint8)
+    elif isinstance(dataset, torch.utils.data.IterableDataset):
+        image = next(iter(dataset))[0]
+    else:
+        image = dataset[0][0]
+    batch_transform = batch_transform_of(dataset)
+    if batch_transform is not None:
+        image = batch_transform(image.unsqueeze(0))[0]
+    return tuple(image.shape)
+
+
+class DeviceDataLoader(object):
+    '''
+    Loader of a dataset read once into a single tensor on a device. The
+    batches are gathered through a permutation of the sample indices drawn
+    at each epoch, and the batch transform of the dataset, if any, is
+    applied on the device. Random per-sample transforms are only drawn once.
+    '''
+
+    def __init__(
+        self, data, batch_size=100, shuffle=True, device='cpu', num_workers=0
+    ):
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.device = device
+        self.batch_transform = batch_transform_of(data)
+
+        images, labels = [], []
+        for image_batch, label_batch in torch.utils.data.DataLoader(
+            data, batch_size=1000, num_workers=num_workers
+        ):
+            images.append(image_batch)
+            labels.append(label_batch)
+        self.images = torch.cat(images).to(device)
+        self.labels = torch.cat(labels).to(device)
+
+    def __len__(self):
+        return (self.labels.shape[0] + self.batch_size - 1) // self.batch_size
+
+    def __iter__(self):
+        num_samples = self.labels.shape[0]
+        if self.shuffle:
+            order = torch.randperm(num_samples, device=self.device)
+        else:
+            order = torch.arange(num_samples, device=self.device)
+        for start in range(0, num_samples, self.batch_size):
+            indices = order[start : start + self.batch_size]
+            images = self.images[indices]
+            if self.batch_transform is not None:
+                images = self.batch_transform(images)
+            yield images, self.labels[indices]
+
+
+def make_data_loader(
+    data,
+    batch_size=100,
+    shuffle=True,
+    num_workers=None,
+    pin_memory=False,
+    persistent_workers=False,
+    prefetch_factor=None,
+    device=None,
+):
+    '''
+    DataLoader applying the batch transform of the dataset, if any, after
+    collation, or a DeviceDataLoader if a device is given.
+    By default one worker process is started for each core available to the
+    rank besides the one running the training.
+    '''
+    batch_transform = batch_transform_of(data)
+    collate_fn = None
+    if batch_transform is not None:
+        collate_fn = BatchCollate(batch_transform)
+    if num_workers is None:
+        num_workers = cores_per_rank() - 1
+    if device is not None:
+        return DeviceDataLoader(data, batch_size, shuffle, device, num_workers)
+    # streaming datasets shuffle their own samples
+    if isinstance(data, torch.utils.data.IterableDataset):
+        shuffle = False
+
+    # the worker options are only accepted with worker processes
+    worker_options = {}
+    if num_workers > 0:
+        worker_options['persistent_workers'] = persistent_workers
+        if prefetch_factor is not None:
+            worker_options['prefetch_factor'] = prefetch_factor
+
+    return torch.utils.data.DataLoader(
+        data,
+        batch_size=batch_size,
+        shuffle=shuffle,
+        collate_fn=collate_fn,
+        num_workers=num_workers,
+        pin_memory=pin_memory,
+        **worker_options
+    )
+
+
+class UInt8Dataset(torch.utils.data.Dataset):
+    '''
+    Dataset of pre-decoded uint8 images of shape (N, C, H, W), normalized to
+    [-1, 1] when accessed, or left as uint8 for the batch transform if there
+    is one. The images can be a np.memmap.
+    '''
+
+    def __init__(self, images, labels, transform=None, batch_transform=None):
+        self.images = images
+        self.targets = labels
+        self.transform = transform
+        self.batch_transform = batch_transform
+
+    def __len__(self):
+        return len(self.targets)
+
+    def __getitem__(self, index):
+        image = torch.from_numpy(np.array(self.images[index]))
+        if self.batch_transform is not None:
+            return image, int(self.targets[index])
+        image = image.float().div_(127.5).sub_(1.0)
+        if self.transform is not None:
+            image = self.transform(image)
+        return image, int(self.targets[index])
+
+
+def read_uint8_images(dataset, images):
+    '''
+    Decode every sample of a dataset returning uint8 tensors into the array
+    images of shape (N, C, H, W). Returns the labels.
+    '''
+    labels = np.empty(len(dataset), dtype=np.int64)
+    loader = torch.utils.data.DataLoader(
+        dataset, batch_size=256, num_workers=os.cpu_count()
+    )
+    start = 0
+    for image_batch, label_batch in loader:
+        end = start + image_batch.shape[0]
+        images[start:end] = image_batch.numpy()
+        labels[start:end] = label_batch.numpy()
+        start = end
+    return labels
+
+
+def write_uint8_images(dataset, path):
+    '''
+    Decode every sample of a dataset returning uint8 tensors once and store
+    the images contiguously as a .npy file. Returns the labels.
+    '''
+    image, _ = dataset[0]
+    shape = (len(dataset),) + tuple(image.shape)
+    tmp_path = '{}.{}.tmp.npy'.format(path, os.getpid())
+    images = np.lib.format.open_memmap(
+        tmp_path, mode='w+', dtype=np.uint8, shape=shape
+    )
+    labels = read_uint8_images(dataset, images)
+    images.flush()
+    del images
+    os.replace(tmp_path, path)
+    return labels
+
+
+def build_cache(dataset, images_path, labels_path):
+    '''
+    Store images and labels of a dataset returning uint8 tensors as .npy
+    files
+    '''
+    labels = write_uint8_images(dataset, images_path)
+    tmp_labels_path = '{}.{}.tmp.npy'.format(labels_path, os.getpid())
+    np.save(tmp_labels_path, labels)
+    # the labels file is written last and marks a complete cache
+    os.replace(tmp_labels_path, labels_path)
+
+
+def cached_data(
+    dataset_name, cache_dir, transform=None, batch_transform=None, reader=True
+):
+    '''
+    Memory-mapped uint8 copy of a dataset, built on first use by one rank
+    per node if it cannot be found in cache_dir. Called by all the ranks,
+    the cache is only opened on the ranks for which reader is True.
+    '''
+    name = '{}_{}'.format(dataset_name, resolutions[dataset_name])
+    images_path = os.path.join(cache_dir, '{}_images.npy'.format(name))
+    labels_path = os.path.join(cache_dir, '{}_labels.npy'.format(name))
+
+    # a cache on a shared filesystem is built once, a node-local one once
+    # per node
+    node_comm = get_node_comm()
+    for comm in (MPI.COMM_WORLD, node_comm):
+        if comm.Get_rank() == 0 and not os.path.exists(labels_path):
+            os.makedirs(cache_dir, exist_ok=True)
+            build_cache(uint8_data(dataset_name), images_path, labels_path)
+        comm.Barrier()
+
+    if not reader:
+        return None
+    return UInt8Dataset(
+        np.load(images_path, mmap_mode='r'),
+        np.load(labels_path),
+        transform,
+        batch_transform,
+    )
+
+
+def class_shard_path(shard_dir, dataset_name, label):
+    return os.path.join(
+        shard_dir,
+        '{}_{}'.format(dataset_name, resolutions[dataset_name]),
+        'class_{:05d}.npy'.format(int(label)),
+    )
+
+
+def write_class_shards(dataset_name, shard_dir):
+    '''
+    Store the training set as one contiguous uint8 .npy file per class.
+    The classes are split among the MPI ranks.
+    '''
+    comm = MPI.COMM_WORLD
+    data = download_once(lambda download: uint8_data(dataset_name, download))
+    labels = torch.unique(dataset_labels(data)).tolist()
+    os.makedirs(
+        os.path.dirname(class_shard_path(shard_dir, dataset_name, 0)),
+        exist_ok=True,
+    )
+    for label in labels[comm.Get_rank() :: comm.Get_size()]:
+        write_uint8_images(
+            label_subset(data, label),
+            class_shard_path(shard_dir, dataset_name, label),
+        )
+    comm.Barrier()
+
+
+class ClassShardDataset(UInt8Dataset):
+    '''
+    Memory-mapped samples of a single class, read from the shard written by
+    write_class_shards without opening the rest of the dataset
+    '''
+
+    def __init__(
+        self,
+        shard_dir,
+        dataset_name,
+        label,
+        transform=None,
+        batch_transform=None,
+    ):
+        images = np.load(
+            class_shard_path(shard_dir, dataset_name, label), mmap_mode='r'
+        )
+        labels = np.full(images.shape[0], int(label), dtype=np.int64)
+        super(ClassShardDataset, self).__init__(
+            images, labels, transform, batch_transform
+        )
+
+
+def class_shard_data(
+    shard_dir, dataset_name, labels, transform=None, batch_transform=None
+):
+    '''
+    Samples of the given classes read from their class shards
+    '''
+    shards = [
+        ClassShardDataset(
+            shard_dir, dataset_name, label, transform, batch_transform
+        )
+        for label in labels
+    ]
+    if len(shards) == 1:
+        return shards[0]
+    return torch.utils.data.ConcatDataset(shards)
+
+
+class LazyClassShards(torch.utils.data.Dataset):
+    '''
+    Samples of all the classes of the shards written by write_class_shards,
+    of which a rank only opens those of the labels it trains on, with
+    label_subset. The number of samples of each class and the shape of an
+    image are read once from the headers of the shards, by the first rank.
+    '''
+
+    def __init__(
+        self,
+        shard_dir,
+        dataset_name,
+        n_classes,
+        transform=None,
+        batch_transform=None,
+    ):
+        self.shard_dir = shard_dir
+        self.dataset_name = dataset_name
+        self.transform = transform
+        self.batch_transform = batch_transform
+        metadata = None
+        if MPI.COMM_WORLD.Get_rank() == 0:
+            # memory-mapping a shard only reads its header
+            shapes = [
+                np.load(
+                    class_shard_path(shard_dir, dataset_name, label),
+                    mmap_mode='r',
+                ).shape
+                for label in range(n_classes)
+            ]
+            metadata = ([shape[0] for shape in shapes], shapes[0][1:])
+        counts, self.image_shape = MPI.COMM_WORLD.bcast(metadata, root=0)
+        self.targets = np.repeat(np.arange(n_classes), counts)
+        self.label_starts = np.concatenate(([0], np.cumsum(counts)))
+        self.shards = {}
+
+    def __len__(self):
+        return len(self.targets)
+
+    def label_subset(self, label):
+        label = int(label)
+        if label not in self.shards:
+            self.shards[label] = ClassShardDataset(
+                self.shard_dir,
+                self.dataset_name,
+                label,
+                self.transform,
+                self.batch_transform,
+            )
+        return self.shards[label]
+
+    def __getitem__(self, index):
+        label = int(self.targets[index])
+        return self.label_subset(label)[index - self.label_starts[label]]
+
+
+class StagedDataset(torch.utils.data.Dataset):
+    '''
+    Dataset read by a single rank of each node, which delivers to every rank
+    of the node the samples of its labels with stage(labels). Until then the
+    ranks only know the labels of all the samples and the shape of an image.
+    Once staged, the dataset is indexed as the staged samples, grouped by
+    label. With shared=True the samples of all the labels of the node are
+    stored once, in a memory segment shared by the ranks of the node.
+    '''
+
+    def __init__(
+        self, source, transform=None, batch_transform=None, shared=False
+    ):
+        # uint8 dataset, opened by the reader of the node only
+        self.source = source
+        metadata = None
+        if source is not None:
+            metadata = (
+                dataset_labels(source).numpy(),
+                tuple(source[0][0].shape),
+            )
+        self.targets, self.image_shape = get_node_comm().bcast(
+            metadata, root=0
+        )
+        self.transform = transform
+        self.batch_transform = batch_transform
+        self.shared = shared
+        self.window = None
+        self.staged = None
+        # sample indices grouped by label
+        self.order = np.argsort(self.targets, kind='stable')
+        self.label_starts = np.concatenate(
+            ([0], np.cumsum(np.bincount(self.targets)))
+        )
+
+    def __len__(self):
+        if self.staged is None:
+            return len(self.targets)
+        return len(self.staged)
+
+    def __getitem__(self, index):
+        if self.staged is None:
+            raise RuntimeError('No sample was staged')
+        return self.staged[index]
+
+    def label_indices(self, labels):
+        # indices of the samples of the given labels, grouped by label, and
+        # empty without labels
+        return np.concatenate(
+            [np.empty(0, dtype=np.int64)]
+            + [
+                self.order[
+                    self.label_starts[label] : self.label_starts[label + 1]
+                ]
+                for label in labels
+            ]
+        ).astype(np.int64)
+
+    def label_subset(self, label):
+        if self.staged is None or int(label) not in self.staged_labels:
+            raise RuntimeError('Label {} was not staged'.format(label))
+        # the samples of a label are contiguous: the subset is a view
+        start, end = self.staged_labels[int(label)]
+        return UInt8Dataset(
+            self.staged.images[start:end],
+            self.staged.targets[start:end],
+            self.transform,
+            self.batch_transform,
+        )
+
+    def read(self, indices, images=None):
+        # images of the given samples of the source, on the reader
+        if images is None:
+            images = np.empty(
+                (len(indices),) + self.image_shape, dtype=np.uint8
+            )
+        sources, offsets = [self.source], [0]
+        if isinstance(self.source, torch.utils.data.ConcatDataset):
+            sources = self.source.datasets
+            offsets = [0] + self.source.cumulative_sizes[:-1]
+        if all(isinstance(source, UInt8Dataset) for source in sources):
+            # pre-decoded images: copied without decoding
+            which = np.searchsorted(offsets, indices, side='right') - 1
+            for n, source in enumerate(sources):
+                mask = which == n
+                if mask.any():
+                    images[mask] = source.images[indices[mask] - offsets[n]]
+        else:
+            read_uint8_images(
+                torch.utils.data.Subset(self.source, indices.tolist()), images
+            )
+        return images
+
+    def stage(self, labels):
+        '''
+        Deliver to each rank of the node the samples of the given labels. The
+        reader decodes only the requested samples, and sends them with a
+        single Scatterv, or a Bcast if all the ranks request the same labels,
+        or writes them once to the shared memory segment of the node.
+        Called by all the ranks of the node.
+        '''
+        node_comm = get_node_comm()
+        labels = sorted(set(int(label) for label in labels))
+        rank_labels = node_comm.gather(labels, root=0)
+        node_labels, same_labels = None, None
+        if node_comm.Get_rank() == 0:
+            node_labels = sorted(set().union(*rank_labels))
+            # decided by the reader for all the ranks, as the ranks must
+            # take part in the same collective
+            same_labels = all(other == labels for other in rank_labels)
+        node_labels, same_labels = node_comm.bcast(
+            (node_labels, same_labels), root=0
+        )
+
+        if self.shared:
+            images = self.stage_shared(node_labels)
+            staged = node_labels
+        else:
+            images = self.stage_sent(labels, same_labels, rank_labels)
+            staged = labels
+
+        self.staged = UInt8Dataset(
+            images,
+            self.targets[self.label_indices(staged)],
+            self.transform,
+            self.batch_transform,
+        )
+        counts = self.label_starts[1:] - self.label_starts[:-1]
+        starts = np.cumsum([0] + [counts[label] for label in staged])
+        self.staged_labels = {
+            label: (starts[n], starts[n + 1])
+            for n, label in enumerate(staged)
+            if label in labels
+        }
+
+    def stage_sent(self, labels, same_labels, rank_labels):
+        # samples of the labels of this rank, sent by the reader
+        node_comm = get_node_comm()
+        indices = self.label_indices(labels)
+        images = np.empty((len(indices),) + self.image_shape, dtype=np.uint8)
+        # counts and displacements in images rather than bytes
+        image_type = MPI.BYTE.Create_contiguous(
+            int(np.prod(self.image_shape))
+        ).Commit()
+        if same_labels:
+            if node_comm.Get_rank() == 0:
+                self.read(indices, images)
+            node_comm.Bcast([images, image_type], root=0)
+        else:
+            send = None
+            if node_comm.Get_rank() == 0:
+                rank_indices = [
+                    self.label_indices(other) for other in rank_labels
+                ]
+                counts = [len(other) for other in rank_indices]
+                displacements = np.cumsum([0] + counts[:-1]).tolist()
+                send = [
+                    self.read(np.concatenate(rank_indices)),
+                    counts,
+                    displacements,
+                    image_type,
+                ]
+            node_comm.Scatterv(send, [images, image_type], root=0)
+        image_type.Free()
+        return images
+
+    def stage_shared(self, node_labels):
+        # samples of the labels of the node, in a segment allocated by the
+        # reader and mapped by the other ranks of the node
+        node_comm = get_node_comm()
+        self.free()
+        indices = self.label_indices(node_labels)
+        shape = (len(indices),) + self.image_shape
+        size = int(np.prod(shape)) if node_comm.Get_rank() == 0 else 0
+        self.window = MPI.Win.Allocate_shared(size, 1, comm=node_comm)
+        buffer, _ = self.window.Shared_query(0)
+        images = np.ndarray(buffer=buffer, dtype=np.uint8, shape=shape)
+        self.window.Fence()
+        if node_comm.Get_rank() == 0:
+            self.read(indices, images)
+        self.window.Fence()
+        return images
+
+    def free(self):
+        '''
+        Release the shared memory segment of the staged samples. Called by
+        all the ranks of the node.
+        '''
+        if self.window is not None:
+            self.staged = None
+            self.window.Free()
+            self.window = None
+
+
+def staged_data(
+    dataset_name,
+    cache_dir=None,
+    shard_dir=None,
+    transform=None,
+    batch_transform=None,
+    shared=False,
+):
+    '''
+    Training set read by one rank per node, from the memory-mapped cache if
+    cache_dir is set or from the class shards if shard_dir is set, whose
+    samples are delivered to the ranks of the node by StagedDataset.stage
+    '''
+    reader = get_node_comm().Get_rank() == 0
+    if shard_dir is not None:
+        source = None
+        if reader:
+            source = class_shard_data(
+                shard_dir, dataset_name, range(num_classes[dataset_name])
+            )
+    elif cache_dir is not None:
+        source = cached_data(dataset_name, cache_dir, reader=reader)
+    else:
+        source = download_once(
+            lambda download: uint8_data(dataset_name, download), reader
+        )
+    return StagedDataset(
+        source if reader else None, transform, batch_transform, shared
+    )
+
+
+def tar_shard_name(label, shard_number):
+    return 'class_{:05d}_{:04d}.tar'.format(int(label), shard_number)
+
+
+def write_tar_shards(image_root, tar_dir, images_per_tar=1000):
+    '''
+    Pack the image files of an ImageFolder directory in tar files of at most
+    images_per_tar images of a single class, written with an index.json of
+    the labels and sizes of the tar files.
+    The classes are split among the MPI ranks.
+    '''
+    comm = MPI.COMM_WORLD
+    folder = datasets.ImageFolder(image_root)
+    os.makedirs(tar_dir, exist_ok=True)
+    index = {}
+    for label in range(len(folder.classes))[
+        comm.Get_rank() :: comm.Get_size()
+    ]:
+        paths = [path for path, target in folder.samples if target == label]
+        for shard_number, start in enumerate(
+            range(0, len(paths), images_per_tar)
+        ):
+            name = tar_shard_name(label, shard_number)
+            tmp_path = os.path.join(tar_dir, name + '.tmp')
+            with tarfile.open(tmp_path, 'w') as tar:
+                for number, path in enumerate(
+                    paths[start : start + images_per_tar], start
+                ):
+                    tar.add(
+                        path,
+                        arcname='{:07d}{}'.format(
+                            number, os.path.splitext(path)[1]
+                        ),
+                    )
+            os.replace(tmp_path, os.path.join(tar_dir, name))
+            index[name] = {
+                'label': label,
+                'size': len(paths[start : start + images_per_tar]),
+            }
+
+    indices = comm.gather(index, root=0)
+    if comm.Get_rank() == 0:
+        for rank_index in indices[1:]:
+            index.update(rank_index)
+        with open(os.path.join(tar_dir, 'index.json'), 'w') as f:
+            json.dump(index, f, indent=1, sort_keys=True)
+    comm.Barrier()
+
+
+class TarShardDataset(torch.utils.data.IterableDataset):
+    '''
+    Stream of the images packed by write_tar_shards. The tar files are read
+    sequentially, open_tars of them at once in turn, as a tar file holds
+    the images of a single class, and the samples are shuffled through a
+    buffer of shuffle_buffer images, so that no file is opened per image.
+    The tar files are split among the DataLoader workers, or their images
+    if there are fewer tar files than workers. A shard of the stream yields
+    exactly len(self) images, repeating or dropping images of its tar
+    files, as its ranks must run the same number of steps.
+    image_shape is the shape of the transformed images, if known, so that
+    the stream is not read to find it.
+    '''
+
+    def __init__(
+        self,
+        tar_dir,
+        transform,
+        labels=None,
+        shuffle_buffer=1000,
+        image_shape=None,
+        open_tars=8,
+    ):
+        self.tar_dir = tar_dir
+        self.transform = transform
+        self.shuffle_buffer = shuffle_buffer
+        self.image_shape = image_shape
+        self.open_tars = open_tars
+        with open(os.path.join(tar_dir, 'index.json')) as f:
+            self.index = json.load(f)
+        if labels is not None:
+            labels = set(int(label) for label in labels)
+            self.index = {
+                name: shard
+                for name, shard in self.index.items()
+                if shard['label'] in labels
+            }
+        self.batch_transform = None
+        # shard of the stream read by this rank, see shard
+        self.shard_index = 0
+        self.shard_count = 1
+
+    def __len__(self):
+        return (
+            sum(shard['size'] for shard in self.index.values())
+            // self.shard_count
+        )
+
+    def label_subset(self, label):
+        subset = TarShardDataset(
+            self.tar_dir,
+            self.transform,
+            [label],
+            self.shuffle_buffer,
+            self.image_shape,
+            self.open_tars,
+        )
+        subset.batch_transform = self.batch_transform
+        subset.shard_index = self.shard_index
+        subset.shard_count = self.shard_count
+        return subset
+
+    def shard(self, index, count):
+        '''
+        Stream of the index-th of count shards: the tar files, or their
+        images, are split among the shards and the DataLoader workers
+        '''
+        shard = copy.copy(self)
+        shard.shard_index = index
+        shard.shard_count = count
+        return shard
+
+    def stream(self):
+        names = sorted(self.index)
+        worker_id, num_workers = 0, 1
+        worker_info = torch.utils.data.get_worker_info()
+        if worker_info is not None:
+            worker_id, num_workers = worker_info.id, worker_info.num_workers
+        # readers of the stream: the workers of all the shards
+        worker_id += self.shard_index * num_workers
+        num_workers *= self.shard_count
+        split_tars = len(names) >= num_workers
+        if split_tars:
+            names = names[worker_id::num_workers]
+        random.shuffle(names)
+
+        def images(name):
+            label = self.index[name]['label']
+            with tarfile.open(
+                os.path.join(self.tar_dir, name), mode='r|'
+            ) as tar:
+                for number, member in enumerate(tar):
+                    if not split_tars and number % num_workers != worker_id:
+                        continue
+                    image = pil.open(
+                        io.BytesIO(tar.extractfile(member).read())
+                    )
+                    yield self.transform(image.convert('RGB')), label
+
+        # one image of each open tar file in turn, the next tar file being
+        # opened when one is read
+        names = iter(names)
+        tars = [
+            images(name) for name in itertools.islice(names, self.open_tars)
+        ]
+        while tars:
+            for tar in list(tars):
+                sample = next(tar, None)
+                if sample is None:
+                    tars.remove(tar)
+                    tars.extend(
+                        images(name) for name in itertools.islice(names, 1)
+                    )
+                    continue
+                yield sample
+
+    def sized_stream(self):
+        # the images of the worker among the len(self) images of the shard
+        worker_id, num_workers = 0, 1
+        worker_info = torch.utils.data.get_worker_info()
+        if worker_info is not None:
+            worker_id, num_workers = worker_info.id, worker_info.num_workers
+        size = len(self) // num_workers
+        size += worker_id < len(self) % num_workers
+        count = 0
+        while count < size:
+            empty = True
+            for sample in itertools.islice(self.stream(), size - count):
+                empty = False
+                count += 1
+                yield sample
+            if empty:
+                return
+
+    def __iter__(self):
+        buffer = []
+        stream = (
+            self.stream() if self.shard_count == 1 else self.sized_stream()
+        )
+        for sample in stream:
+            if len(buffer) < self.shuffle_buffer:
+                buffer.append(sample)
+                continue
+            index = random.randrange(len(buffer))
+            yield buffer[index]
+            buffer[index] = sample
+        random.shuffle(buffer)
+        for sample in buffer:
+            yield sample
+
+
+class SyntheticDataset(torch.utils.data.Dataset):
+    '''
+    Deterministic random images in [-1, 1] generated in memory, with
+    samples_per_class images around a random mean image for each class.
+    The images of a class are generated the first time one of them is read,
+    so that a rank only generates the classes it trains on.
+    '''
+
+    def __init__(self, n_classes, image_shape, samples_per_class, seed=0):
+        self.n_classes = n_classes
+        self.image_shape = tuple(image_shape)
+        self.samples_per_class = samples_per_class
+        self.seed = seed
+        self.targets = torch.arange(n_classes).repeat_interleave(
+            samples_per_class
+        )
+        self.class_images = {}
+
+    def __len__(self):
+        return self.n_classes * self.samples_per_class
+
+    def images(self, label):
+        if label not in self.class_images:
+            generator = torch.Generator()
+            generator.manual_seed(self.seed * self.n_classes + label)
+            mean = torch.rand(self.image_shape, generator=generator) * 2 - 1
+            images = 0.25 * torch.randn(
+                (self.samples_per_class,) + self.image_shape,
+                generator=generator,
+            )
+            self.class_images[label] = images.add_(mean).clamp_(-1.0, 1.0)
+        return self.class_images[label]
+
+    def label_subset(self, label):
+        # generated before the DataLoader workers are started
+        self.images(int(label))
+        start = int(label) * self.samples_per_class
+        return torch.utils.data.Subset(
+            self, range(start, start + self.samples_per_class)
+        )
+
+    def __getitem__(self, index):
+        label = index // self.samples_per_class
+        return self.images(label)[index % self.samples_per_class], label
+
+
+def synthetic_data(
+    n_classes=10, image_shape=(3, 64, 64), samples_per_class=1000
+):
+    return SyntheticDataset(n_classes, image_shape, samples_per_class)
+
+
+def mnist_data(
+    rand_rotation=False, max_degree=90, cache_dir=None, batch_transforms=False
+):
+    batch_transform = None
+    if batch_transforms:
+        batch_transform = dataset_batch_transform(
+            'MNIST', rand_rotation, max_degree
+        )
+    if cache_dir is not None:
+        return cached_data(
+            'MNIST',
+            cache_dir,
+            # rotated-in pixels are black as in the PIL pipeline
+            transforms.RandomRotation(max_degree, fill=-1.0)
+            if rand_rotation and not batch_transforms
+            else None,
+            batch_transform,
+        )
+
+    if batch_transforms:
+        compose = transforms.PILToTensor()
+    elif rand_rotation == True:
         compose = transforms.Compose(
             [
                 transforms.Resize(28),
@@ -37,52 +1148,105 @@ def mnist_data(rand_rotation=False, max_degree=90):
             ]
         )
     out_dir = '{}/dataset'.format(os.getcwd())
-    return datasets.MNIST(
-        root=out_dir, train=True, transform=compose, download=True
+    train_dataset = download_once(
+        lambda download: datasets.MNIST(
+            root=out_dir, train=True, transform=compose, download=download
+        )
     )
+    train_dataset.batch_transform = batch_transform
+    return train_dataset
 
 
-def cifar10_data():
-    compose = transforms.Compose(
-        [
-            transforms.Resize(64),
-            transforms.ToTensor(),
-            transforms.Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5)),
-        ]
-    )
+def cifar10_data(cache_dir=None, batch_transforms=False):
+    batch_transform = None
+    if batch_transforms:
+        batch_transform = dataset_batch_transform('CIFAR10')
+    if cache_dir is not None:
+        return cached_data('CIFAR10', cache_dir, None, batch_transform)
+
+    if batch_transforms:
+        compose = transforms.PILToTensor()
+    else:
+        compose = transforms.Compose(
+            [
+                transforms.Resize(64),
+                transforms.ToTensor(),
+                transforms.Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5)),
+            ]
+        )
     out_dir = '{}/dataset'.format(os.getcwd())
-    return datasets.CIFAR10(
-        root=out_dir, train=True, transform=compose, download=True
+    train_dataset = download_once(
+        lambda download: datasets.CIFAR10(
+            root=out_dir, train=True, transform=compose, download=download
+        )
     )
+    train_dataset.batch_transform = batch_transform
+    return train_dataset
 
 
-def cifar100_data():
-    compose = transforms.Compose(
-        [
-            transforms.Resize(64),
-            transforms.ToTensor(),
-            transforms.Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5)),
-        ]
-    )
+def cifar100_data(cache_dir=None, batch_transforms=False):
+    batch_transform = None
+    if batch_transforms:
+        batch_transform = dataset_batch_transform('CIFAR100')
+    if cache_dir is not None:
+        return cached_data('CIFAR100', cache_dir, None, batch_transform)
+
+    if batch_transforms:
+        compose = transforms.PILToTensor()
+    else:
+        compose = transforms.Compose(
+            [
+                transforms.Resize(64),
+                transforms.ToTensor(),
+                transforms.Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5)),
+            ]
+        )
     out_dir = '{}/dataset'.format(os.getcwd())
-    return datasets.CIFAR100(
-        root=out_dir, train=True, transform=compose, download=True
+    train_dataset = download_once(
+        lambda download: datasets.CIFAR100(
+            root=out_dir, train=True, transform=compose, download=download
+        )
     )
+    train_dataset.batch_transform = batch_transform
+    return train_dataset
 
 
-def imagenet_data():
-    data_path = '/Users/7ml/Documents/ImageNet1k/'
+def imagenet_data(
+    cache_dir=None, batch_transforms=False, tar_dir=None, shuffle_buffer=1000
+):
+    batch_transform = None
+    if batch_transforms:
+        batch_transform = dataset_batch_transform('IMAGENET1K')
+    if cache_dir is not None:
+        if batch_transforms:
+            return cached_data('IMAGENET1K', cache_dir, None, batch_transform)
+        return cached_data(
+            'IMAGENET1K', cache_dir, uint8_augmentation('IMAGENET1K')
+        )
 
-    traindir = os.path.join(data_path, "train")
-    train_dataset = datasets.ImageFolder(
-        traindir,
-        transforms.Compose(
+    if batch_transforms:
+        # images are collated at a common size, the random crop is then taken
+        # from a center crop of twice the training resolution
+        image_size = 2 * 64
+        compose = uint8_transform(image_size, center_crop=True)
+    else:
+        image_size = 64
+        compose = transforms.Compose(
             [
-                transforms.RandomResizedCrop(64),
+                transforms.RandomResizedCrop(image_size),
                 transforms.ToTensor(),
                 transforms.Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5)),
             ]
-        ),
-    )
-
+        )
+    if tar_dir is not None:
+        train_dataset = TarShardDataset(
+            tar_dir,
+            compose,
+            shuffle_buffer=shuffle_buffer,
+            image_shape=(3, image_size, image_size),
+        )
+    else:
+        traindir = os.path.join(imagenet_path, "train")
+        train_dataset = datasets.ImageFolder(traindir, compose)
+    train_dataset.batch_transform = batch_transform
     return train_dataset
@@ -11,12 +11,15 @@ Created on Sat Apr  4 17:34:40 2020
         : Vittorio Gabbi (e-mail: vittorio.gabbi@mail.polimi.it) 
 
 """
+import copy
+import random
 import torch
 import numpy
 from models import *
 from optimizers import *
 from Dataloader import *
 from utils import *
+from scheduling import LabelQueue
 import time
 import PIL.Image as pil
 import numpy as np
@@ -27,6 +30,11 @@ from mpi4py import MPI
 
 
 class GANs_model(metaclass=ABCMeta):
+    # each MPI rank trains on the samples of a single label
+    label_partitioned = True
+    # the pairs of several labels can be trained at once by train_stacked
+    stackable = True
+
     def __init__(self, data, n_classes, model_name):
         self.mpi_comm_size = MPI.COMM_WORLD.Get_size()
         self.mpi_rank = MPI.COMM_WORLD.Get_rank()
@@ -34,12 +42,30 @@ class GANs_model(metaclass=ABCMeta):
         self.list_gpuIDs = get_gpus_list()
         self.data = data
         self.n_classes = n_classes
-        self.data_dimension = self.data[0][0].numpy().shape
+        self.data_dimension = sample_shape(self.data)
         self.D, self.G = self.build_models()
         self.D_error_real_history = []
         self.D_error_fake_history = []
         self.G_error_history = []
         self.model_name = model_name
+        # label trained by train_labels, None when training on all the data
+        self.label = None
+        # AsyncMetrics channel of the training progress, if any
+        self.metrics = None
+        # communicator of the ranks training the same labels on shards of
+        # their samples, if any
+        self.label_comm = None
+        # conjugate gradient solves of the CGD optimizers started from the
+        # solution of the previous step, and their numbers of iterations
+        self.cg_warm_start = False
+        self.cg_iterations = []
+        # preconditioner of the conjugate gradient solves, if any
+        self.cg_preconditioner = None
+        # CGPolicy terminating the conjugate gradient solves, if any
+        self.cg_policy = None
+        # end times of the training steps while they are timed, see
+        # measure_step_time
+        self.step_times = None
 
         if self.data_dimension[0] == 3:
             self.imtype = "RGB"
@@ -55,6 +81,12 @@ class GANs_model(metaclass=ABCMeta):
         if self.verbose and self.mpi_rank == 0:
             print(*args, **kwargs)
 
+    def post_metrics(self, epoch, N, error_real, error_fake, g_error):
+        if self.step_times is not None:
+            self.step_times.append(time.time())
+        if self.metrics is not None:
+            self.metrics.step(N, epoch + 1, error_real, error_fake, g_error)
+
     def createFolder(self, directory):
         try:
             if not os.path.exists(directory):
@@ -62,11 +94,12 @@ class GANs_model(metaclass=ABCMeta):
         except OSError:
             print("Error: Creating directory. " + directory)
 
-    def save_models(self):
+    def save_models(self, label=None):
         # G_directory = self.createFolder("/G_model")
         # D_directory = self.createFolder("/D_model")
-        filename_D = "D_state_dict.pth"
-        filename_G = "G_state_dict.pth"
+        suffix = "" if label is None else "_label_" + str(label)
+        filename_D = "D_state_dict" + suffix + ".pth"
+        filename_G = "G_state_dict" + suffix + ".pth"
         torch.save(self.G.state_dict(), filename_G)
         torch.save(self.D.state_dict(), filename_D)
 
@@ -77,11 +110,12 @@ class GANs_model(metaclass=ABCMeta):
         D = self.build_discriminator()
         G = self.build_generator()
 
-        # In peresence of GPUs available, map the models on the GPUs
+        # In peresence of GPUs available, map the models on the GPUs.
+        # The GPUs and cores of a node are shared by the ranks of the node.
         num_gpus = len(self.list_gpuIDs)
         if num_gpus > 0:
-            rank = self.mpi_rank
-            comm_size = self.mpi_comm_size
+            rank = get_node_comm().Get_rank()
+            comm_size = get_node_comm().Get_size()
 
             num_ranks_with_2_gpus = max(
                 min(num_gpus - comm_size, comm_size), 0
@@ -104,9 +138,22 @@ class GANs_model(metaclass=ABCMeta):
 
         D.to(self.discriminator_device)
         G.to(self.generator_device)
+        flatten_parameters(D)
+        flatten_parameters(G)
 
         return D, G
 
+    def set_num_threads(self, num_workers=None, device_resident=False):
+        # the models trained on the CPU use the cores of the rank, less those
+        # given to DataLoader workers by the user, which only read the data
+        # once when it is device resident. The default workers mostly wait
+        # for the training and leave it all the cores.
+        if self.discriminator_device != "cpu":
+            return
+        if num_workers is None or device_resident:
+            num_workers = 0
+        torch.set_num_threads(max(cores_per_rank() - num_workers, 1))
+
     @abstractmethod
     def build_discriminator(self):
         pass
@@ -163,9 +210,24 @@ class GANs_model(metaclass=ABCMeta):
         #    )
         else:
             raise RuntimeError("Optimizer type is not valid")
+        self.optimizer.comm = self.label_comm
+        self.optimizer.warm_start = self.cg_warm_start
+        self.optimizer.preconditioner = self.cg_preconditioner
+        self.optimizer.policy = self.cg_policy
+
+    def shard_data(self, data):
+        # shard of the samples of this rank among the ranks of self.label_comm
+        if self.label_comm is None:
+            return data
+        return shard_subset(
+            data, self.label_comm.Get_rank(), self.label_comm.Get_size()
+        )
 
     def save_images(self, epoch_number, n_batch, images):
+        if self.step_times is not None:
+            return
         count = 0
+        label_name = "" if self.label is None else "_label_" + str(self.label)
         for image_index in range(0, images.shape[0]):
             count = count + 1
             if self.imtype == "RGB":
@@ -179,6 +241,7 @@ class GANs_model(metaclass=ABCMeta):
                     + "/fake_image"
                     + "_MPI_rank_"
                     + str(self.mpi_rank)
+                    + label_name
                     + "_Epoch_"
                     + str(epoch_number + 1)
                     + "_Batch_"
@@ -199,6 +262,7 @@ class GANs_model(metaclass=ABCMeta):
                     + "/fake_image"
                     + "_MPI_rank_"
                     + str(self.mpi_rank)
+                    + label_name
                     + "_Epoch_"
                     + str(epoch_number + 1)
                     + "_Batch_"
@@ -209,6 +273,362 @@ class GANs_model(metaclass=ABCMeta):
                 )
                 img.save(path)
 
+    def train_labels(self, labels, save=False, stack_size=1, **kwargs):
+        """
+        Train in turn the generator/discriminator pair of each label, all
+        starting from the initial weights of the models, with the keyword
+        arguments of train. A label None trains on all the data.
+        With the Adam optimizer and stack_size > 1, the pairs of stack_size
+        labels are trained at once by train_stacked.
+        The labels can be a LabelQueue, from which the next labels are taken
+        when the previous ones are trained.
+        The loss histories of each label are kept in self.label_histories.
+        """
+        initial_D = copy.deepcopy(self.D.state_dict())
+        initial_G = copy.deepcopy(self.G.state_dict())
+        self.label_histories = {}
+        self.set_num_threads(
+            kwargs.get('num_workers'), kwargs.get('device_resident', False)
+        )
+        if kwargs.get('optimizer_name') != 'Adam':
+            stack_size = 1
+        if isinstance(labels, LabelQueue):
+            stacks = iter(lambda: labels.take(stack_size), [])
+        else:
+            if None in labels:
+                stack_size = 1
+            stacks = (
+                labels[start : start + stack_size]
+                for start in range(0, len(labels), stack_size)
+            )
+        for stack in stacks:
+            self.D.load_state_dict(initial_D)
+            self.G.load_state_dict(initial_G)
+            broadcast_parameters([self.D, self.G], self.label_comm)
+            if len(stack) > 1:
+                self.train_stacked(stack, **kwargs)
+                for index, label in enumerate(stack):
+                    self.load_stacked(index)
+                    if save:
+                        self.save_models(label)
+                continue
+
+            label = stack[0]
+            self.label = label
+            self.D_error_real_history = []
+            self.D_error_fake_history = []
+            self.G_error_history = []
+
+            self.train(
+                single_number=None if label is None else torch.tensor(label),
+                **kwargs
+            )
+            self.cg_iterations.extend(self.optimizer.cg_iterations)
+
+            self.label_histories[label] = (
+                self.D_error_real_history,
+                self.D_error_fake_history,
+                self.G_error_history,
+            )
+            if save:
+                self.save_models(label)
+
+    def generator_input(self, N):
+        # noise fed to the generator by train_stacked
+        return noise(N, self.noise_dimension)
+
+    def discriminator_input(self, images):
+        # real images fed to the discriminator by train_stacked
+        return images
+
+    def output_images(self, output):
+        # images of the output of the generator
+        return output
+
+    def train_stacked(
+        self,
+        labels,
+        loss=torch.nn.BCEWithLogitsLoss(),
+        lr_x=torch.tensor([0.001]),
+        lr_y=torch.tensor([0.001]),
+        num_epochs=1,
+        batch_size=100,
+        verbose=True,
+        save_path="./data_fake",
+        num_workers=None,
+        pin_memory=False,
+        persistent_workers=False,
+        prefetch_factor=None,
+        device_resident=False,
+        b1=0.5,
+        b2=0.999,
+        **kwargs
+    ):
+        """
+        Train the generator/discriminator pairs of several labels at once
+        with Adam, as in the unconditional step of the Adam optimizer.
+        The K pairs start from the weights of self.G and self.D, their
+        parameters are stacked along a first dimension of size K, and their
+        forward and backward passes are vectorized with torch.func.vmap over
+        the K batches of the labels. The running statistics of batch
+        normalization are stacked as well, one per label.
+        An epoch lasts as many steps as the largest label has batches, the
+        smaller labels being restarted, and the K batches of a step are cut
+        to the size of the smallest one. self.load_stacked(k) copies the
+        weights of the k-th pair in self.G and self.D.
+        """
+        from torch.func import (
+            functional_call,
+            stack_module_state,
+            vmap,
+        )
+
+        K = len(labels)
+        self.verbose = verbose
+        self.save_path = save_path
+        self.num_test_samples = 5
+        self.display_progress = 50
+
+        if num_workers is None:
+            num_workers = cores_per_rank() - 1
+        data_loaders = [
+            make_data_loader(
+                self.shard_data(label_subset(self.data, label)),
+                batch_size=batch_size,
+                num_workers=num_workers // K,
+                pin_memory=pin_memory,
+                persistent_workers=persistent_workers,
+                prefetch_factor=prefetch_factor,
+                device=self.discriminator_device if device_resident else None,
+            )
+            for label in labels
+        ]
+        n_batches = max(len(data_loader) for data_loader in data_loaders)
+
+        def batches(data_loader):
+            while True:
+                for real_batch, _ in data_loader:
+                    yield real_batch
+
+        label_batches = [batches(data_loader) for data_loader in data_loaders]
+
+        G = copy.deepcopy(self.G)
+        D = copy.deepcopy(self.D)
+        self.G_stacked, self.G_stacked_buffers = stack_module_state([G] * K)
+        self.D_stacked, self.D_stacked_buffers = stack_module_state([D] * K)
+        G_buffers = self.G_stacked_buffers
+        D_buffers = self.D_stacked_buffers
+
+        def G_call(params, buffers, z):
+            return functional_call(G, (params, buffers), (z,))
+
+        def D_call(params, buffers, x):
+            return functional_call(D, (params, buffers), (x,)).reshape(-1)
+
+        G_vmap = vmap(G_call, randomness='different')
+        D_vmap = vmap(D_call, randomness='different')
+        loss_vmap = vmap(loss)
+
+        optimizer_G = torch.optim.Adam(
+            list(self.G_stacked.values()), lr=lr_x.item(), betas=(b1, b2)
+        )
+        optimizer_D = torch.optim.Adam(
+            list(self.D_stacked.values()), lr=lr_y.item(), betas=(b1, b2)
+        )
+
+        def G_grads():
+            return [p.grad for p in self.G_stacked.values()]
+
+        def D_grads():
+            return [p.grad for p in self.D_stacked.values()]
+
+        for label in labels:
+            self.label_histories[label] = ([], [], [])
+        start = time.time()
+        for e in range(num_epochs):
+            self.print_verbose(
+                "######################################################"
+            )
+            for n_batch in range(n_batches):
+                real_batches = [next(real) for real in label_batches]
+                N = min(real_batch.size(0) for real_batch in real_batches)
+                real_data = torch.stack(
+                    [
+                        self.discriminator_input(real_batch[:N])
+                        for real_batch in real_batches
+                    ]
+                ).to(self.discriminator_device)
+                z = torch.stack([self.generator_input(N) for _ in labels])
+                label_1 = torch.ones(K, N, device=self.discriminator_device)
+                label_0 = torch.zeros(K, N, device=self.discriminator_device)
+
+                # Generator step
+                optimizer_G.zero_grad()
+                fake_data = G_vmap(
+                    self.G_stacked, G_buffers, z.to(self.generator_device)
+                )
+                d_pred_fake = D_vmap(
+                    self.D_stacked,
+                    D_buffers,
+                    fake_data.to(self.discriminator_device),
+                )
+                g_error = loss_vmap(d_pred_fake, label_1)
+                g_error.sum().backward()
+                allreduce_mean(G_grads(), self.label_comm)
+                optimizer_G.step()
+
+                # Discriminator step
+                optimizer_D.zero_grad()
+                d_pred_real = D_vmap(self.D_stacked, D_buffers, real_data)
+                error_real = loss_vmap(d_pred_real, label_1)
+                d_pred_fake = D_vmap(
+                    self.D_stacked,
+                    D_buffers,
+                    fake_data.detach().to(self.discriminator_device),
+                )
+                error_fake = loss_vmap(d_pred_fake, label_0)
+                ((error_real + error_fake) / 2).sum().backward()
+                allreduce_mean(D_grads(), self.label_comm)
+                optimizer_D.step()
+
+                self.print_verbose('Epoch: ', str(e + 1), '/', str(num_epochs))
+                self.print_verbose('Batch Number: ', str(n_batch + 1))
+                self.print_verbose(
+                    'Mean over the stacked labels:',
+                    'Error_discriminator__real: ',
+                    "{:.5e}".format(error_real.mean().item()),
+                    'Error_discriminator__fake: ',
+                    "{:.5e}".format(error_fake.mean().item()),
+                    'Error_generator: ',
+                    "{:.5e}".format(g_error.mean().item()),
+                )
+                self.post_metrics(
+                    e,
+                    K * N,
+                    error_real.mean().item(),
+                    error_fake.mean().item(),
+                    g_error.mean().item(),
+                )
+
+                # as in train, the test images are saved by about 10 ranks
+                # at most, and by the first rank of a label only
+                if (
+                    n_batch % self.display_progress == 0
+                    and (
+                        self.label_comm is None
+                        or self.label_comm.Get_rank() == 0
+                    )
+                    and self.mpi_rank
+                    in random.sample(
+                        range(self.mpi_comm_size), min(self.mpi_comm_size, 10)
+                    )
+                ):
+                    with torch.no_grad():
+                        test_noise = torch.stack(
+                            [
+                                self.generator_input(self.num_test_samples)
+                                for _ in labels
+                            ]
+                        )
+                        test_images = G_vmap(
+                            self.G_stacked,
+                            G_buffers,
+                            test_noise.to(self.generator_device),
+                        )
+                    for label, images in zip(labels, test_images):
+                        self.label = label
+                        self.save_images(
+                            e, n_batch, self.output_images(images)
+                        )
+
+            for label, errors in zip(
+                labels, zip(error_real, error_fake, g_error)
+            ):
+                for history, error in zip(self.label_histories[label], errors):
+                    history.append(error.item())
+
+            self.print_verbose(
+                "######################################################"
+            )
+        end = time.time()
+        self.print_verbose('Total Time[s]: ', str(end - start))
+
+    def load_stacked(self, index):
+        """
+        Copy the weights and buffers of a pair of models trained by
+        train_stacked in self.G and self.D
+        """
+        with torch.no_grad():
+            for name, p in self.G.named_parameters():
+                p.copy_(self.G_stacked[name][index])
+            for name, p in self.D.named_parameters():
+                p.copy_(self.D_stacked[name][index])
+            for name, b in self.G.named_buffers():
+                b.copy_(self.G_stacked_buffers[name][index])
+            for name, b in self.D.named_buffers():
+                b.copy_(self.D_stacked_buffers[name][index])
+
+    def measure_step_time(
+        self, warmup_batches, stack_size=1, batch_size=100, **kwargs
+    ):
+        """
+        Seconds per training step of the models of this rank, measured on
+        warmup_batches batches of synthetic images of the shape of the data,
+        after an untimed first step. Only the steps are timed: neither the
+        setup of the training, nor the reading of the data or the saving of
+        test images is included. With stack_size > 1, a step of stack_size
+        labels trained at once by train_stacked is timed.
+        The weights of the models are restored afterwards.
+        """
+        initial_D = copy.deepcopy(self.D.state_dict())
+        initial_G = copy.deepcopy(self.G.state_dict())
+        data = self.data
+        # timed with the threads of the training, without the other ranks of
+        # the label
+        self.set_num_threads(
+            kwargs.get('num_workers'), kwargs.get('device_resident', False)
+        )
+        label_comm = self.label_comm
+        self.label_comm = None
+        label_histories = getattr(self, 'label_histories', {})
+        if kwargs.get('optimizer_name') != 'Adam':
+            stack_size = 1
+        kwargs.update(
+            num_epochs=1,
+            batch_size=batch_size,
+            verbose=False,
+            num_workers=0,
+            persistent_workers=False,
+            prefetch_factor=None,
+        )
+        # the steps end when their metrics are posted
+        self.step_times = []
+        try:
+            self.data = synthetic_data(
+                stack_size,
+                self.data_dimension,
+                (warmup_batches + 1) * batch_size,
+            )
+            if stack_size > 1:
+                self.label_histories = {}
+                self.train_stacked(list(range(stack_size)), **kwargs)
+            else:
+                self.train(single_number=torch.tensor(0), **kwargs)
+            step_time = (self.step_times[-1] - self.step_times[0]) / (
+                len(self.step_times) - 1
+            )
+        finally:
+            self.data = data
+            self.label_comm = label_comm
+            self.label_histories = label_histories
+            self.step_times = None
+        self.D.load_state_dict(initial_D)
+        self.G.load_state_dict(initial_G)
+        self.D_error_real_history = []
+        self.D_error_fake_history = []
+        self.G_error_history = []
+        return step_time
+
     @abstractmethod
     def train(
         self,
@@ -223,5 +643,10 @@ class GANs_model(metaclass=ABCMeta):
         label_smoothing=False,
         single_number=None,
         repeat_iterations=1,
+        num_workers=None,
+        pin_memory=False,
+        persistent_workers=False,
+        prefetch_factor=None,
+        device_resident=False,
     ):
         pass
@@ -16,10 +16,12 @@ import GANs_abstract_object
 from models import *
 from optimizers import *
 from utils import *
+from Dataloader import *
 
 
 class CGANs_CNN_model(GANs_abstract_object.GANs_model):
     model_name = 'CNN-CGANs'
+    label_partitioned = False
 
     def __init__(self, data, n_classes, model_name):
         super(CGANs_CNN_model, self).__init__(data, n_classes, model_name)
@@ -54,23 +56,31 @@ class CGANs_CNN_model(GANs_abstract_object.GANs_model):
         label_smoothing=False,
         single_number=None,
         repeat_iterations=1,
+        num_workers=None,
+        pin_memory=False,
+        persistent_workers=False,
+        prefetch_factor=None,
+        device_resident=False,
     ):
         if single_number is not None:
-            self.data = [
-                i for i in self.data if i[1] == torch.tensor(single_number)
-            ]
-            self.data_loader = torch.utils.data.DataLoader(
-                self.data, batch_size=100, shuffle=True
-            )
+            data = label_subset(self.data, single_number)
             self.num_test_samples = 5
             self.display_progress = 50
         else:
-            self.data_loader = torch.utils.data.DataLoader(
-                self.data, batch_size=100, shuffle=True
-            )
+            data = self.data
             self.num_test_samples = 16
             self.display_progress = 100
 
+        self.data_loader = make_data_loader(
+            self.shard_data(data),
+            batch_size=batch_size,
+            num_workers=num_workers,
+            pin_memory=pin_memory,
+            persistent_workers=persistent_workers,
+            prefetch_factor=prefetch_factor,
+            device=self.discriminator_device if device_resident else None,
+        )
+
         self.verbose = verbose
         self.save_path = save_path
         self.optimizer_initialize(
@@ -119,6 +129,7 @@ class CGANs_CNN_model(GANs_abstract_object.GANs_model):
                     'Error_generator: ',
                     "{:.5e}".format(g_error),
                 )
+                self.post_metrics(e, N, error_real, error_fake, g_error)
 
                 if (n_batch) % self.display_progress == 0:
                     test_images = self.G(
@@ -24,6 +24,7 @@ import GANs_abstract_object
 from models import *
 from optimizers import *
 from utils import *
+from Dataloader import *
 
 
 class GANs_CNN_model(GANs_abstract_object.GANs_model):
@@ -45,6 +46,12 @@ class GANs_CNN_model(GANs_abstract_object.GANs_model):
         G.apply(weights_init_normal)
         return G
 
+    def generator_input(self, N):
+        return torch.randn(N, self.noise_dimension, 1, 1)
+
+    def train_stacked(self, labels, loss=torch.nn.BCELoss(), **kwargs):
+        super(GANs_CNN_model, self).train_stacked(labels, loss=loss, **kwargs)
+
     # loss = torch.nn.BCEWithLogitsLoss()
     # loss = torch.nn.BCELoss()
     # loss = binary_cross_entropy
@@ -61,6 +68,11 @@ class GANs_CNN_model(GANs_abstract_object.GANs_model):
         label_smoothing=False,
         single_number=None,
         repeat_iterations=1,
+        num_workers=None,
+        pin_memory=False,
+        persistent_workers=False,
+        prefetch_factor=None,
+        device_resident=False,
     ):
         if single_number is not None or self.mpi_comm_size > 1:
             self.num_test_samples = 5
@@ -68,20 +80,23 @@ class GANs_CNN_model(GANs_abstract_object.GANs_model):
             if single_number is None and self.mpi_comm_size > 1:
                 single_number = torch.tensor(self.mpi_rank)
 
-            self.data = [
-                i for i in self.data if i[1] == torch.tensor(single_number)
-            ]
-            self.data_loader = torch.utils.data.DataLoader(
-                self.data, batch_size=100, shuffle=True
-            )
+            data = label_subset(self.data, single_number)
             self.display_progress = 50
         else:
-            self.data_loader = torch.utils.data.DataLoader(
-                self.data, batch_size=100, shuffle=True
-            )
+            data = self.data
             self.num_test_samples = 10
             self.display_progress = 100
 
+        self.data_loader = make_data_loader(
+            self.shard_data(data),
+            batch_size=batch_size,
+            num_workers=num_workers,
+            pin_memory=pin_memory,
+            persistent_workers=persistent_workers,
+            prefetch_factor=prefetch_factor,
+            device=self.discriminator_device if device_resident else None,
+        )
+
         self.verbose = verbose
         self.save_path = save_path
         self.optimizer_initialize(
@@ -120,23 +135,10 @@ class GANs_CNN_model(GANs_abstract_object.GANs_model):
                             p_x,
                             p_y,
                         ) = self.optimizer.step(real_data, N)
+                        self.optimizer.average([p_x, p_y])
 
-                        index = 0
-                        for p in self.G.parameters():
-                            p.data.add_(
-                                p_x[index : index + p.numel()].reshape(p.shape)
-                            )
-                            index += p.numel()
-                        if index != p_x.numel():
-                            raise RuntimeError('size mismatch')
-                        index = 0
-                        for p in self.D.parameters():
-                            p.data.add_(
-                                p_y[index : index + p.numel()].reshape(p.shape)
-                            )
-                            index += p.numel()
-                        if index != p_y.numel():
-                            raise RuntimeError('size mismatch')
+                        self.G.flat_parameters.add_(p_x)
+                        self.D.flat_parameters.add_(p_y)
 
                 self.print_verbose('Epoch: ', str(e + 1), '/', str(num_epochs))
                 self.print_verbose('Batch Number: ', str(n_batch + 1))
@@ -148,6 +150,7 @@ class GANs_CNN_model(GANs_abstract_object.GANs_model):
                     'Error_generator: ',
                     "{:.5e}".format(g_error),
                 )
+                self.post_metrics(e, N, error_real, error_fake, g_error)
 
                 if ((n_batch) % self.display_progress == 0) and (
                     self.mpi_rank
@@ -2,11 +2,14 @@ from models import *
 import GANs_abstract_object
 from optimizers import *
 from utils import *
+from Dataloader import *
 import torch
 
 
 class ResNet_model(GANs_abstract_object.GANs_model):
     model_name = 'ResNet'
+    # its generator and discriminator are not vectorized by train_stacked
+    stackable = False
 
     def build_discriminator(self, FMAP_D=64):
 
@@ -50,31 +53,35 @@ class ResNet_model(GANs_abstract_object.GANs_model):
         label_smoothing=False,
         single_number=None,
         repeat_iterations=1,
+        num_workers=None,
+        pin_memory=False,
+        persistent_workers=False,
+        prefetch_factor=None,
+        device_resident=False,
     ):
-        self.data_loader = torch.utils.data.DataLoader(
-            self.data, batch_size=100, shuffle=True
-        )
-
         if single_number is not None or self.mpi_comm_size > 1:
             self.num_test_samples = 5
 
             if single_number is None and self.mpi_comm_size > 1:
                 single_number = torch.tensor(self.mpi_rank)
 
-            self.data = [
-                i for i in self.data if i[1] == torch.tensor(single_number)
-            ]
-            self.data_loader = torch.utils.data.DataLoader(
-                self.data, batch_size=100, shuffle=True
-            )
+            data = label_subset(self.data, single_number)
             self.display_progress = 50
         else:
-            self.data_loader = torch.utils.data.DataLoader(
-                self.data, batch_size=100, shuffle=True
-            )
+            data = self.data
             self.num_test_samples = 10
             self.display_progress = 100
 
+        self.data_loader = make_data_loader(
+            self.shard_data(data),
+            batch_size=batch_size,
+            num_workers=num_workers,
+            pin_memory=pin_memory,
+            persistent_workers=persistent_workers,
+            prefetch_factor=prefetch_factor,
+            device=self.discriminator_device if device_resident else None,
+        )
+
         self.verbose = verbose
         self.save_path = save_path
         self.optimizer_initialize(
@@ -112,23 +119,10 @@ class ResNet_model(GANs_abstract_object.GANs_model):
                             p_x,
                             p_y,
                         ) = self.optimizer.step(real_data, N)
+                        self.optimizer.average([p_x, p_y])
 
-                        index = 0
-                        for p in self.G.parameters():
-                            p.data.add_(
-                                p_x[index : index + p.numel()].reshape(p.shape)
-                            )
-                            index += p.numel()
-                        if index != p_x.numel():
-                            raise RuntimeError('CG size mismatch')
-                        index = 0
-                        for p in self.D.parameters():
-                            p.data.add_(
-                                p_y[index : index + p.numel()].reshape(p.shape)
-                            )
-                            index += p.numel()
-                        if index != p_y.numel():
-                            raise RuntimeError('Size mismatch')
+                        self.G.flat_parameters.add_(p_x)
+                        self.D.flat_parameters.add_(p_y)
 
                 self.D_error_real_history.append(error_real)
                 self.D_error_fake_history.append(error_fake)
@@ -144,6 +138,7 @@ class ResNet_model(GANs_abstract_object.GANs_model):
                     'Error_generator: ',
                     "{:.5e}".format(g_error),
                 )
+                self.post_metrics(e, N, error_real, error_fake, g_error)
 
                 if (n_batch) % self.display_progress == 0:
                     test_images = self.optimizer.G(
@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Throughput of the input pipeline of Dataloader.py, without training.
+Each MPI rank loads the samples of one label, as in main_GANs.py, for every
+combination of dataset, data source, transform strategy and number of
+DataLoader workers, and measures:
+  - startup: seconds to open the dataset, select the label and build the loader
+  - first_batch: seconds to the first batch
+  - images_per_s: images per second delivered after the first batch, over
+    as many epochs as needed to draw the timed batches
+One JSON record per rank and combination is written to the output file.
+
+Usage:
+  benchmark_dataloader.py (-h | --help)
+  benchmark_dataloader.py [-d DATASETS] [-s SOURCES] [-t TRANSFORMS] [-w WORKERS] [-b BATCH_SIZE] [-n BATCHES]
+                          [--cache_dir=<str>] [--shard_dir=<str>] [--imagenet_tar_dir=<str>] [--device_resident] [-o OUTPUT]
+
+Options:
+  -h, --help                  Show this screen.
+  -d, --datasets=<str>        Comma separated datasets. MNIST, CIFAR10, CIFAR100, IMAGENET1K, SYNTHETIC [default: MNIST]
+  -s, --sources=<str>         Comma separated data sources. dataset, cache, shards, tar [default: dataset]
+  -t, --transforms=<str>      Comma separated transform strategies. sample, batch [default: sample,batch]
+  -w, --num_workers=<str>     Comma separated numbers of DataLoader workers [default: 0]
+  -b, --batch_size=<n>        Number of images per batch [default: 100].
+  -n, --batches=<n>           Number of batches timed after the first one, over as many epochs as needed [default: 100].
+  --cache_dir=<str>           Directory of the memory-mapped dataset cache, required by the cache source.
+  --shard_dir=<str>           Directory of the class shards, required by the shards source.
+  --imagenet_tar_dir=<str>    Directory of the IMAGENET1K tar files, required by the tar source.
+  --device_resident           Also time the device-resident loader.
+  -o, --output=<str>          File of the JSON records, one per line [default: benchmark_dataloader.jsonl]
+"""
+
+from docopt import docopt
+import json
+import time
+import mpi4py
+
+mpi4py.rc.initialize = False
+mpi4py.rc.finalize = False
+from mpi4py import MPI
+
+from Dataloader import *
+
+MPI.Init()
+
+
+def build_data(dataset_name, source, batched, label, args):
+    '''
+    Samples of a label read from the given source, or None if the source
+    is not available for the dataset
+    '''
+    if dataset_name == 'SYNTHETIC':
+        if source != 'dataset' or batched:
+            return None
+        return label_subset(synthetic_data(), label)
+
+    if source == 'shards':
+        if args['--shard_dir'] is None:
+            return None
+        if batched:
+            return ClassShardDataset(
+                args['--shard_dir'],
+                dataset_name,
+                label,
+                batch_transform=dataset_batch_transform(dataset_name),
+            )
+        return ClassShardDataset(
+            args['--shard_dir'],
+            dataset_name,
+            label,
+            uint8_augmentation(dataset_name),
+        )
+
+    if source == 'cache':
+        cache_dir = args['--cache_dir']
+        if cache_dir is None:
+            return None
+    elif source == 'tar':
+        if dataset_name != 'IMAGENET1K' or args['--imagenet_tar_dir'] is None:
+            return None
+    elif source != 'dataset':
+        raise RuntimeError('Data source not recognized')
+    if source != 'cache':
+        cache_dir = None
+
+    if dataset_name == 'MNIST':
+        data = mnist_data(cache_dir=cache_dir, batch_transforms=batched)
+    elif dataset_name == 'CIFAR10':
+        data = cifar10_data(cache_dir=cache_dir, batch_transforms=batched)
+    elif dataset_name == 'CIFAR100':
+        data = cifar100_data(cache_dir=cache_dir, batch_transforms=batched)
+    elif dataset_name == 'IMAGENET1K':
+        data = imagenet_data(
+            cache_dir=cache_dir,
+            batch_transforms=batched,
+            tar_dir=args['--imagenet_tar_dir'] if source == 'tar' else None,
+        )
+    else:
+        raise RuntimeError('Dataset not recognized')
+    return label_subset(data, label)
+
+
+def time_loader(loader, n_batches):
+    '''
+    Seconds to the first batch, and images and seconds of the next n_batches
+    batches, drawn from as many epochs as needed. The timer is stopped
+    before the iterator, and its workers, are torn down.
+    '''
+    start = time.perf_counter()
+    batches = iter(loader)
+    next(batches)
+    first_batch = time.perf_counter() - start
+
+    images, n_batch = 0, 0
+    start = time.perf_counter()
+    while n_batch < n_batches:
+        for real_batch, _ in batches:
+            images += real_batch.shape[0]
+            n_batch += 1
+            if n_batch == n_batches:
+                break
+        else:
+            # next epoch, not empty as it has a first batch
+            batches = iter(loader)
+    seconds = time.perf_counter() - start
+    return first_batch, images, seconds
+
+
+if __name__ == '__main__':
+    args = docopt(__doc__)
+    comm = MPI.COMM_WORLD
+    rank = comm.Get_rank()
+    batch_size = int(args['--batch_size'])
+    n_batches = int(args['--batches'])
+
+    loaders = ['DataLoader']
+    if args['--device_resident']:
+        loaders.append('device')
+
+    records = []
+    for dataset_name in args['--datasets'].split(','):
+        n_classes = num_classes.get(dataset_name, 10)
+        label = rank % n_classes
+        for source in args['--sources'].split(','):
+            for transform in args['--transforms'].split(','):
+                for num_workers in args['--num_workers'].split(','):
+                    for loader_name in loaders:
+                        comm.Barrier()
+                        start = time.perf_counter()
+                        data = build_data(
+                            dataset_name,
+                            source,
+                            transform == 'batch',
+                            label,
+                            args,
+                        )
+                        if data is None:
+                            continue
+                        loader = make_data_loader(
+                            data,
+                            batch_size=batch_size,
+                            num_workers=int(num_workers),
+                            # the workers are not restarted at each epoch
+                            persistent_workers=True,
+                            device='cpu' if loader_name == 'device' else None,
+                        )
+                        startup = time.perf_counter() - start
+                        first_batch, images, seconds = time_loader(
+                            loader, n_batches
+                        )
+                        records.append(
+                            {
+                                'dataset': dataset_name,
+                                'resolution': resolutions.get(dataset_name),
+                                'source': source,
+                                'transform': transform,
+                                'loader': loader_name,
+                                'num_workers': int(num_workers),
+                                'batch_size': batch_size,
+                                'rank': rank,
+                                'label': label,
+                                'startup': startup,
+                                'first_batch': first_batch,
+                                'images': images,
+                                'seconds': seconds,
+                                'images_per_s': images / seconds
+                                if seconds > 0
+                                else None,
+                            }
+                        )
+
+    all_records = comm.gather(records, root=0)
+
+    if rank == 0:
+        with open(args['--output'], 'w') as f:
+            for rank_records in all_records:
+                for record in rank_records:
+                    f.write(json.dumps(record) + '\n')
+
+        # summary over the ranks of each combination
+        for index, record in enumerate(all_records[0]):
+            combination = [rank_records[index] for rank_records in all_records]
+            print(
+                '{dataset} {source} {transform} {loader} '
+                'workers={num_workers}:'.format(**record),
+                '{:.1f} images/s,'.format(
+                    sum(r['images_per_s'] or 0.0 for r in combination)
+                ),
+                'max startup {:.3f} s,'.format(
+                    max(r['startup'] for r in combination)
+                ),
+                'max first batch {:.3f} s'.format(
+                    max(r['first_batch'] for r in combination)
+                ),
+            )
+
+MPI.Finalize()
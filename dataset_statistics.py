@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Global and per-class mean and variance of the pixel values of each channel of
+a training set, and the F ratio of the one-way analysis of variance between
+the classes.
+The statistics are computed in a single streaming pass over the uint8
+training images (Chan et al. pairwise update of count, mean and sum of
+squared deviations), with the classes split among the MPI ranks.
+The images of the dataset are read at their original size, without the
+training transform, while the class shards are stored at the training
+resolution: the statistics of the shards are those of the resized images.
+
+Usage:
+  dataset_statistics.py (-h | --help)
+  dataset_statistics.py [-d DATASET] [--shard_dir=<str>] [-b BATCH_SIZE] [--num_workers=<n>]
+
+Options:
+  -h, --help                  Show this screen.
+  -d, --dataset=<str>         Dataset. MNIST, CIFAR10, CIFAR100, IMAGENET1K [default: CIFAR100]
+  --shard_dir=<str>           Read the class shards written by make_class_shards.py instead of the dataset, at the training resolution.
+  -b, --batch_size=<n>        Number of images read at once [default: 1000].
+  --num_workers=<n>           DataLoader worker processes of each rank. Defaults to the cores available to each rank of the node, minus one.
+"""
+
+from docopt import docopt
+import numpy as np
+import mpi4py
+
+mpi4py.rc.initialize = False
+mpi4py.rc.finalize = False
+from mpi4py import MPI
+
+from Dataloader import *
+
+MPI.Init()
+
+
+def merge_statistics(a, b):
+    '''
+    Statistics (count, mean, sum of squared deviations) of the union of two
+    sets of values from the statistics of each set
+    '''
+    count_a, mean_a, m2_a = a
+    count_b, mean_b, m2_b = b
+    count = count_a + count_b
+    if count == 0:
+        return a
+    delta = mean_b - mean_a
+    mean = mean_a + delta * count_b / count
+    m2 = m2_a + m2_b + delta ** 2 * count_a * count_b / count
+    return count, mean, m2
+
+
+def batch_statistics(images):
+    '''
+    Statistics of the values of each channel of a batch of shape (B, C, H, W)
+    '''
+    values = images.double().transpose(0, 1).reshape(images.shape[1], -1)
+    mean = values.mean(dim=1)
+    m2 = ((values - mean.unsqueeze(1)) ** 2).sum(dim=1)
+    return values.shape[1], mean.numpy(), m2.numpy()
+
+
+def class_statistics(batches):
+    statistics = (0, 0.0, 0.0)
+    for images in batches:
+        statistics = merge_statistics(statistics, batch_statistics(images))
+    return statistics
+
+
+def dataset_batches(data, batch_size, num_workers):
+    for images, _ in torch.utils.data.DataLoader(
+        data, batch_size=batch_size, num_workers=num_workers
+    ):
+        yield images
+
+
+def image_batches(data, num_workers):
+    # images of different sizes, read one at a time
+    for image, _ in torch.utils.data.DataLoader(
+        data, batch_size=None, num_workers=num_workers
+    ):
+        yield image.unsqueeze(0)
+
+
+def shard_batches(shard, batch_size):
+    for start in range(0, shard.images.shape[0], batch_size):
+        yield torch.from_numpy(
+            np.array(shard.images[start : start + batch_size])
+        )
+
+
+if __name__ == '__main__':
+    args = docopt(__doc__)
+    comm = MPI.COMM_WORLD
+    dataset_name = args['--dataset']
+    batch_size = int(args['--batch_size'])
+    num_workers = args['--num_workers']
+    if num_workers is None:
+        num_workers = cores_per_rank() - 1
+    num_workers = int(num_workers)
+
+    if args['--shard_dir'] is None:
+        data = download_once(
+            lambda download: uint8_data(dataset_name, download, native=True)
+        )
+        labels = torch.unique(dataset_labels(data)).tolist()
+    else:
+        labels = list(range(num_classes[dataset_name]))
+
+    local_statistics = {}
+    for label in labels[comm.Get_rank() :: comm.Get_size()]:
+        if args['--shard_dir'] is None and dataset_name == 'IMAGENET1K':
+            batches = image_batches(label_subset(data, label), num_workers)
+        elif args['--shard_dir'] is None:
+            batches = dataset_batches(
+                label_subset(data, label), batch_size, num_workers
+            )
+        else:
+            batches = shard_batches(
+                ClassShardDataset(args['--shard_dir'], dataset_name, label),
+                batch_size,
+            )
+        local_statistics[label] = class_statistics(batches)
+
+    all_statistics = comm.gather(local_statistics, root=0)
+
+    if comm.Get_rank() == 0:
+        statistics = {}
+        for rank_statistics in all_statistics:
+            statistics.update(rank_statistics)
+
+        global_statistics = (0, 0.0, 0.0)
+        for label in sorted(statistics):
+            count, mean, m2 = statistics[label]
+            print("######################")
+            print("Class: " + str(label))
+            print('Pixels per channel: {}'.format(count))
+            print(mean, m2 / count)
+            global_statistics = merge_statistics(
+                global_statistics, statistics[label]
+            )
+        print("######################")
+
+        count, mean, m2 = global_statistics
+        print('Global mean and variance: ', mean, m2 / count)
+
+        # one-way analysis of variance of the pixel values between classes
+        g = len(statistics)
+        SS_b = sum(
+            n_class * (mean_class - mean) ** 2
+            for n_class, mean_class, _ in statistics.values()
+        )
+        SS_w = sum(m2_class for _, _, m2_class in statistics.values())
+        print("Variance between groups: ", SS_b / count)
+        F_ratio = (SS_b / (g - 1)) / (SS_w / (count - g))
+        print("F ratio: ", F_ratio)
+
+MPI.Finalize()
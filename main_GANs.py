@@ -12,6 +12,12 @@
 Usage:
   main_GANS.py (-h | --help)
   main_GANS.py [-c CONFIG_FILE] [-m MODEL] [-e EPOCHS] [-o OPTIMIZER] [-r LEARNING_RATE] [-d DATASET] [--display] [--save] [--list]
+              [--cache_dir=<str>] [--shard_dir=<str>] [--stage] [--shared_memory] [--batch_transforms]
+              [-b BATCH_SIZE] [--num_workers=<n>] [--prefetch_factor=<n>] [--persistent_workers] [--pin_memory]
+              [--imagenet_tar_dir=<str>] [--shuffle_buffer=<n>] [--device_resident]
+              [--synthetic_classes=<n>] [--synthetic_shape=<str>] [--synthetic_samples=<n>]
+              [--warmup_batches=<n>] [--stack_size=<n>] [--metrics_interval=<n>] [--ranks_per_label=<n>] [--label_queue]
+              [--cg_warm_start] [--cg_preconditioner=<str>] [--cg_rtol=<f>] [--cg_max_iter=<n>] [--cg_time_budget=<f>] [--cg_forcing=<f>]
 
 Options:
   -h, --help                  Show this screen.
@@ -24,12 +30,40 @@ Options:
   -m, --model=<str>           Implementation of GANs model. Multi-layer perceptrons NN (MLP), convolutional NN (CNN), conditional MLP (C-GANs), conditional CNN (CNN-CGANs), resnet, (ResNet) [default: MLP].
   -o, --optimizer=<str>       Optimizer name [default: Jacobi].
   -r, --learning_rate=<f>     Learning rate [default: 0.01].
-  -d, --dataset=<srt>         Datased used for training. MNIST, CIFAR10, CIFAR100 [default: CIFAR10]
+  -d, --dataset=<srt>         Datased used for training. MNIST, CIFAR10, CIFAR100, IMAGENET1K, SYNTHETIC [default: CIFAR10]
+  --cache_dir=<str>           Directory of the memory-mapped uint8 dataset cache, built on first use. No cache if not set.
+  --shard_dir=<str>           Directory of the class shards written by make_class_shards.py. Each rank only opens the shard of its label.
+  --stage                     Read the dataset, its cache or its shards on one rank per node only, which sends to each rank of the node the samples of its labels.
+  --shared_memory             Read the dataset, its cache or its shards on one rank per node only, which stores the samples of the labels of the node once in memory shared by the ranks of the node.
+  --batch_transforms          Resize, augment and normalize whole uint8 batches after collation instead of single images.
+  -b, --batch_size=<n>        Number of images per batch [default: 100].
+  --num_workers=<n>           DataLoader worker processes of each rank. Defaults to the cores available to each rank of the node, minus one.
+  --prefetch_factor=<n>       Batches loaded in advance by each DataLoader worker.
+  --persistent_workers        Keep the DataLoader workers alive between epochs.
+  --pin_memory                Load the batches in page-locked memory.
+  --imagenet_tar_dir=<str>    Stream IMAGENET1K sequentially from the tar files written by make_class_shards.py -f tar, instead of reading the ImageFolder.
+  --shuffle_buffer=<n>        Number of images shuffled in memory when streaming from tar files [default: 1000].
+  --device_resident           Load the training samples of each rank once in a tensor on the device of the discriminator, and draw the batches from it.
+  --synthetic_classes=<n>     Number of classes of the SYNTHETIC dataset [default: 10].
+  --synthetic_shape=<str>     Shape of the images of the SYNTHETIC dataset [default: 3,64,64].
+  --synthetic_samples=<n>     Number of images per class of the SYNTHETIC dataset [default: 1000].
+  --warmup_batches=<n>        Batches timed on each rank before training, to balance the labels between ranks with the measured time of a step. The labels are balanced with their number of samples only if 0 [default: 0].
+  --stack_size=<n>            Number of labels of a rank trained at once, as stacked models vectorized with torch.func.vmap. Only with the Adam optimizer and the MLP and CNN models [default: 1].
+  --metrics_interval=<n>      Training steps between two non-blocking posts of the losses and throughput of each rank, printed by rank 0 during training. No posts if 0 [default: 0].
+  --ranks_per_label=<n>       Number of ranks training the same labels, each on a shard of their samples, with the gradients or updates averaged between them at each step [default: 1].
+  --label_queue               Hand out the labels, longest first, to the groups of ranks from a queue, each group taking the next label once it has trained the previous one, instead of balancing the labels between the groups before training.
+  --cg_warm_start             Start the conjugate gradient solves of the CGD and CGD_multi optimizers from the solution of the previous training step, rescaled to the new right-hand side.
+  --cg_preconditioner=<str>   Preconditioner of the conjugate gradient solves of the CGD and CGD_multi optimizers. none, hutchinson (diagonal estimated with random probes), square_avg (diagonal estimated from the running average of the squared gradients) [default: none].
+  --cg_rtol=<f>               Relative residual at which the conjugate gradient solves of the CGD and Newton optimizers stop [default: 1e-8].
+  --cg_max_iter=<n>           Maximum number of iterations of a conjugate gradient solve. Defaults to the number of parameters of the model solved for, 1000 with Newton.
+  --cg_time_budget=<f>        Seconds after which a conjugate gradient solve stops. No limit if not set.
+  --cg_forcing=<f>            Relative residual of the first conjugate gradient solve, the tolerance of the next ones being scaled by the norm of their right-hand side, down to cg_rtol, as the forcing terms of inexact Newton methods. cg_rtol for all the solves if not set.
 """
 
 from docopt import docopt
 import matplotlib.pyplot as plt
 import sys, os
+import time
 import yaml
 import torch
 import mpi4py
@@ -42,6 +76,8 @@ from mpi4py import MPI
 plt.rcParams.update({'font.size': 14})
 
 from Dataloader import *
+from scheduling import balance_labels, LabelQueue
+from utils import AsyncMetrics, CGPolicy, preconditioners
 
 list_GANs = {}
 
@@ -124,19 +160,85 @@ if __name__ == '__main__':
     optimizer_name = config['optimizer']
     learning_rate = float(config['learning_rate'])
     model_name = config['model']
+    cache_dir = config['cache_dir']
+    batch_transforms = config['batch_transforms']
+    batch_size = int(config['batch_size'])
+    num_workers = config['num_workers']
+    if num_workers is not None:
+        num_workers = int(num_workers)
+    prefetch_factor = config['prefetch_factor']
+    if prefetch_factor is not None:
+        prefetch_factor = int(prefetch_factor)
 
-    if config['dataset'] == 'MNIST':
-        data = mnist_data(rand_rotation=False, max_degree=90)
+    mpi_comm_size = MPI.COMM_WORLD.Get_size()
+    mpi_rank = MPI.COMM_WORLD.Get_rank()
+    label_partitioned = (
+        mpi_comm_size > 1
+        and model_name in list_GANs
+        and list_GANs[model_name].label_partitioned
+    )
+
+    if config['stage'] or config['shared_memory'] or config['shard_dir']:
+        if config['dataset'] not in num_classes:
+            raise RuntimeError('Dataset not recognized')
+        n_classes = num_classes[config['dataset']]
+        # uint8 images, transformed by batch or by sample
+        if batch_transforms:
+            transform_args = dict(
+                batch_transform=dataset_batch_transform(config['dataset'])
+            )
+        else:
+            transform_args = dict(
+                transform=uint8_augmentation(config['dataset'])
+            )
+    if config['stage'] or config['shared_memory']:
+        data = staged_data(
+            config['dataset'],
+            cache_dir,
+            config['shard_dir'],
+            shared=config['shared_memory'],
+            **transform_args
+        )
+    elif config['shard_dir'] is not None:
+        # the shards are memory-mapped: only those of the labels trained by
+        # the rank are opened
+        data = LazyClassShards(
+            config['shard_dir'], config['dataset'], n_classes, **transform_args
+        )
+    elif config['dataset'] == 'MNIST':
+        data = mnist_data(
+            rand_rotation=False,
+            max_degree=90,
+            cache_dir=cache_dir,
+            batch_transforms=batch_transforms,
+        )
         n_classes = 10
     elif config['dataset'] == 'CIFAR10':
-        data = cifar10_data()
+        data = cifar10_data(
+            cache_dir=cache_dir, batch_transforms=batch_transforms
+        )
         n_classes = 10
     elif config['dataset'] == 'CIFAR100':
-        data = cifar100_data()
+        data = cifar100_data(
+            cache_dir=cache_dir, batch_transforms=batch_transforms
+        )
         n_classes = 100
     elif config['dataset'] == 'IMAGENET1K':
-        data = imagenet_data()
+        data = imagenet_data(
+            cache_dir=cache_dir,
+            batch_transforms=batch_transforms,
+            tar_dir=config['imagenet_tar_dir'],
+            shuffle_buffer=int(config['shuffle_buffer']),
+        )
         n_classes = 1000
+    elif config['dataset'] == 'SYNTHETIC':
+        n_classes = int(config['synthetic_classes'])
+        image_shape = config['synthetic_shape']
+        if isinstance(image_shape, str):
+            image_shape = [int(size) for size in image_shape.split(',')]
+        data = synthetic_data(
+            n_classes, image_shape, int(config['synthetic_samples'])
+        )
     else:
         raise RuntimeError('Dataset not recognized')
 
@@ -149,118 +251,273 @@ if __name__ == '__main__':
             )
         )
 
-    model.train(
+    if int(config['stack_size']) > 1 and not model.stackable:
+        raise RuntimeError(
+            'The {} model cannot be trained with stack_size > 1'.format(
+                model_name
+            )
+        )
+
+    train_args = dict(
         num_epochs=epochs,
         lr_x=torch.tensor([learning_rate]),
         lr_y=torch.tensor([learning_rate]),
         optimizer_name=optimizer_name,
         verbose=True,
         label_smoothing=False,
-        single_number=None,
         repeat_iterations=1,
+        batch_size=batch_size,
+        num_workers=num_workers,
+        pin_memory=config['pin_memory'],
+        persistent_workers=config['persistent_workers'],
+        prefetch_factor=prefetch_factor,
+        device_resident=config['device_resident'],
     )  # save_path = ''
 
-    mpi_comm_size = MPI.COMM_WORLD.Get_size()
-    mpi_rank = MPI.COMM_WORLD.Get_rank()
-
-    if mpi_rank == 0:
-        if config['save']:
-            print("Saving the model...")
-            model.save_models()
-
-    if config['display']:
-        plt.figure()
-        plt.plot(
-            [x for x in range(0, len(model.D_error_real_history))],
-            model.D_error_real_history,
-        )
-        plt.plot(
-            [x for x in range(0, len(model.D_error_fake_history))],
-            model.D_error_fake_history,
-        )
-        plt.plot(
-            [x for x in range(0, len(model.G_error_history))],
-            model.G_error_history,
+    # solver of the CGD optimizers, set before the steps are timed
+    model.cg_warm_start = config['cg_warm_start']
+    model.cg_policy = CGPolicy(
+        rtol=float(config['cg_rtol']),
+        max_iter=None
+        if config['cg_max_iter'] is None
+        else int(config['cg_max_iter']),
+        time_budget=None
+        if config['cg_time_budget'] is None
+        else float(config['cg_time_budget']),
+        forcing=None
+        if config['cg_forcing'] is None
+        else float(config['cg_forcing']),
+    )
+    if config['cg_preconditioner'] != 'none':
+        if config['cg_preconditioner'] not in preconditioners:
+            raise RuntimeError('Preconditioner not recognized')
+        model.cg_preconditioner = config['cg_preconditioner']
+
+    # with several ranks, each group of ranks_per_label ranks trains in turn
+    # the pairs of its labels on shards of their samples, and the labels are
+    # balanced between the groups by number of steps and time of a step
+    label_leader = True
+    if label_partitioned:
+        ranks_per_label = int(config['ranks_per_label'])
+        if mpi_comm_size % ranks_per_label != 0:
+            raise RuntimeError(
+                'The number of ranks is not a multiple of ranks_per_label'
+            )
+        group = mpi_rank // ranks_per_label
+        model.label_comm = MPI.COMM_WORLD.Split(group, mpi_rank)
+        label_leader = model.label_comm.Get_rank() == 0
+
+        label_steps = [
+            epochs * int(np.ceil(count // ranks_per_label / batch_size))
+            for count in class_sample_counts(data, n_classes)
+        ]
+        # labels trained at once by a step, as in train_labels
+        stack_size = int(config['stack_size'])
+        if optimizer_name != 'Adam':
+            stack_size = 1
+        warmup_batches = int(config['warmup_batches'])
+        if config['label_queue']:
+            # the groups that finish first take more labels
+            labels = LabelQueue(
+                sorted(
+                    range(n_classes), key=lambda label: -label_steps[label]
+                ),
+                model.label_comm,
+            )
+        else:
+            step_time = 1.0
+            if warmup_batches > 0:
+                step_time = model.measure_step_time(
+                    warmup_batches, stack_size, **train_args
+                )
+            step_times = MPI.COMM_WORLD.allgather(step_time)
+            # a step of stack_size labels advances each of them by a step
+            all_labels, predicted_times = balance_labels(
+                [steps / stack_size for steps in label_steps],
+                [
+                    max(step_times[rank : rank + ranks_per_label])
+                    for rank in range(0, mpi_comm_size, ranks_per_label)
+                ],
+            )
+            labels = all_labels[group]
+    else:
+        labels = [None]
+
+    if isinstance(data, StagedDataset):
+        # the reader of each node sends to each rank the samples it trains
+        # on, all of them when the labels are taken from the queue
+        if isinstance(labels, LabelQueue) or labels == [None]:
+            data.stage(range(n_classes))
+        else:
+            data.stage(labels)
+
+    metrics_interval = int(config['metrics_interval'])
+    if metrics_interval > 0:
+        model.metrics = AsyncMetrics(metrics_interval)
+
+    start = time.time()
+    model.train_labels(
+        labels,
+        save=config['save']
+        and label_leader
+        and (label_partitioned or mpi_rank == 0),
+        stack_size=int(config['stack_size']),
+        **train_args
+    )
+    training_time = time.time() - start
+
+    if model.metrics is not None:
+        model.metrics.close()
+
+    if isinstance(data, StagedDataset):
+        data.free()
+
+    if isinstance(labels, LabelQueue):
+        labels.free()
+        training_times = MPI.COMM_WORLD.gather(training_time, root=0)
+        trained_labels = MPI.COMM_WORLD.gather(
+            list(model.label_histories), root=0
         )
-        plt.xlabel('Epochs')
-        plt.ylabel('Loss function value')
-        plt.legend(
-            [
-                'Discriminator: Loss on Real Data',
-                'Discriminator: Loss on Fake Data',
-                'Generator: Loss',
+        if mpi_rank == 0:
+            print(
+                'Labels taken from the queue and training time of each group'
+            )
+            for rank in range(0, mpi_comm_size, ranks_per_label):
+                ranks = range(rank, rank + ranks_per_label)
+                print(
+                    'Ranks {}-{}: {} labels'.format(
+                        ranks[0], ranks[-1], len(trained_labels[rank])
+                    ),
+                    trained_labels[rank],
+                    'achieved {:.4g} s'.format(
+                        max(training_times[rank] for rank in ranks)
+                    ),
+                )
+    elif label_partitioned:
+        training_times = MPI.COMM_WORLD.gather(training_time, root=0)
+        if mpi_rank == 0:
+            print('Predicted and achieved training time of each group')
+            achieved_times = [
+                max(training_times[rank : rank + ranks_per_label])
+                for rank in range(0, mpi_comm_size, ranks_per_label)
             ]
+            if warmup_batches == 0:
+                # the labels were balanced by number of steps: the time of
+                # the steps is predicted from their mean achieved time
+                predicted_times = np.array(predicted_times) * (
+                    sum(achieved_times) / sum(predicted_times)
+                )
+            for group, group_labels in enumerate(all_labels):
+                ranks = range(
+                    group * ranks_per_label, (group + 1) * ranks_per_label
+                )
+                print(
+                    'Ranks {}-{}: {} labels,'.format(
+                        ranks[0], ranks[-1], len(group_labels)
+                    ),
+                    'predicted {:.4g} s,'.format(predicted_times[group]),
+                    'achieved {:.4g} s'.format(achieved_times[group]),
+                )
+
+    cg_iterations = MPI.COMM_WORLD.gather(model.cg_iterations, root=0)
+    if mpi_rank == 0 and any(cg_iterations):
+        cg_iterations = np.concatenate(cg_iterations)
+        print(
+            'Conjugate gradient: {} solves,'.format(len(cg_iterations)),
+            '{:.4g} iterations per solve on average,'.format(
+                cg_iterations.mean()
+            ),
+            '{} at most'.format(cg_iterations.max()),
         )
-        plt.savefig('cost_report' + str(mpi_rank) + '.png')
-
-        averageD_error_real_history = np.zeros(len(model.D_error_real_history))
-        averageD_error_fake_history = np.zeros(len(model.D_error_fake_history))
-        averageG_error_history = np.zeros(len(model.G_error_history))
-        stdD_error_real_history = np.zeros(len(model.D_error_real_history))
-        stdD_error_fake_history = np.zeros(len(model.D_error_fake_history))
-        stdG_error_history = np.zeros(len(model.G_error_history))
-
-        for i in range(0, len(model.D_error_real_history)):
-            pointwise_error_LOC = np.zeros(mpi_comm_size)
-            pointwise_error_LOC[mpi_rank] = model.D_error_real_history[i]
-            pointwise_error_GLOB = np.zeros(mpi_comm_size)
-            MPI.COMM_WORLD.Reduce(
-                pointwise_error_LOC, pointwise_error_GLOB, op=MPI.SUM, root=0
-            )
-            mean_val = np.mean(pointwise_error_GLOB)
-            averageD_error_real_history[i] = mean_val
-
-        for i in range(0, len(model.D_error_fake_history)):
-            pointwise_error_LOC = np.zeros(mpi_comm_size)
-            pointwise_error_LOC[mpi_rank] = model.D_error_fake_history[i]
-            pointwise_error_GLOB = np.zeros(mpi_comm_size)
-            MPI.COMM_WORLD.Reduce(
-                pointwise_error_LOC, pointwise_error_GLOB, op=MPI.SUM, root=0
-            )
-            mean_val = np.mean(pointwise_error_GLOB)
-            averageD_error_fake_history[i] = mean_val
-
-        for i in range(0, len(model.G_error_history)):
-            pointwise_error_LOC = np.zeros(mpi_comm_size)
-            pointwise_error_LOC[mpi_rank] = model.G_error_history[i]
-            pointwise_error_GLOB = np.zeros(mpi_comm_size)
-            MPI.COMM_WORLD.Reduce(
-                pointwise_error_LOC, pointwise_error_GLOB, op=MPI.SUM, root=0
+
+    if mpi_rank == 0 and config['save']:
+        print("Models saved")
+
+    if config['display']:
+        # the histories of a label are reported by the first rank of its group
+        label_histories = model.label_histories if label_leader else {}
+        for label, label_history in label_histories.items():
+            (
+                D_error_real_history,
+                D_error_fake_history,
+                G_error_history,
+            ) = label_history
+            plt.figure()
+            plt.plot(
+                [x for x in range(0, len(D_error_real_history))],
+                D_error_real_history,
             )
-            mean_val = np.mean(pointwise_error_GLOB)
-            averageG_error_history[i] = mean_val
-
-        for i in range(0, len(model.D_error_real_history)):
-            pointwise_error_LOC = np.zeros(mpi_comm_size)
-            pointwise_error_LOC[mpi_rank] = model.D_error_real_history[i]
-            pointwise_error_GLOB = np.zeros(mpi_comm_size)
-            MPI.COMM_WORLD.Reduce(
-                pointwise_error_LOC, pointwise_error_GLOB, op=MPI.SUM, root=0
+            plt.plot(
+                [x for x in range(0, len(D_error_fake_history))],
+                D_error_fake_history,
             )
-            standard_deviation = np.std(pointwise_error_GLOB)
-            stdD_error_real_history[i] = standard_deviation
-
-        for i in range(0, len(model.D_error_fake_history)):
-            pointwise_error_LOC = np.zeros(mpi_comm_size)
-            pointwise_error_LOC[mpi_rank] = model.D_error_fake_history[i]
-            pointwise_error_GLOB = np.zeros(mpi_comm_size)
-            MPI.COMM_WORLD.Reduce(
-                pointwise_error_LOC, pointwise_error_GLOB, op=MPI.SUM, root=0
+            plt.plot(
+                [x for x in range(0, len(G_error_history))], G_error_history,
             )
-            standard_deviation = np.std(pointwise_error_GLOB)
-            stdD_error_fake_history[i] = standard_deviation
-
-        for i in range(0, len(model.G_error_history)):
-            pointwise_error_LOC = np.zeros(mpi_comm_size)
-            pointwise_error_LOC[mpi_rank] = model.G_error_history[i]
-            pointwise_error_GLOB = np.zeros(mpi_comm_size)
-            MPI.COMM_WORLD.Reduce(
-                pointwise_error_LOC, pointwise_error_GLOB, op=MPI.SUM, root=0
+            plt.xlabel('Epochs')
+            plt.ylabel('Loss function value')
+            plt.legend(
+                [
+                    'Discriminator: Loss on Real Data',
+                    'Discriminator: Loss on Fake Data',
+                    'Generator: Loss',
+                ]
             )
-            standard_deviation = np.std(pointwise_error_GLOB)
-            stdG_error_history[i] = standard_deviation
+            if label is None:
+                plt.savefig('cost_report' + str(mpi_rank) + '.png')
+            else:
+                plt.savefig('cost_report_label_' + str(label) + '.png')
+            plt.close()
+
+        # loss histories of all the labels, gathered in a single collective
+        # as [3, epochs] blocks (the labels may have trained different epochs)
+        blocks = [
+            np.array(
+                [[float(error) for error in history] for history in histories],
+                dtype=np.float64,
+            ).reshape(3, -1)
+            for histories in label_histories.values()
+        ]
+        lengths = [block.shape[1] for block in blocks]
+        histories = np.concatenate(
+            [block.ravel() for block in blocks] + [np.empty(0)]
+        )
+        rank_lengths = MPI.COMM_WORLD.gather(lengths, root=0)
+        recvbuf = None
+        if mpi_rank == 0:
+            lengths = [
+                length for lengths in rank_lengths for length in lengths
+            ]
+            all_histories = np.empty(3 * sum(lengths))
+            recvbuf = [
+                all_histories,
+                [3 * sum(lengths) for lengths in rank_lengths],
+                MPI.DOUBLE,
+            ]
+        MPI.COMM_WORLD.Gatherv(histories, recvbuf, root=0)
 
         if mpi_rank == 0:
+            # pad the shorter histories with NaN, ignored by the statistics
+            pointwise_error_GLOB = np.full(
+                (len(lengths), 3, max(lengths)), np.nan
+            )
+            offset = 0
+            for index, length in enumerate(lengths):
+                pointwise_error_GLOB[index, :, :length] = all_histories[
+                    offset : offset + 3 * length
+                ].reshape(3, length)
+                offset += 3 * length
+            (
+                averageD_error_real_history,
+                averageD_error_fake_history,
+                averageG_error_history,
+            ) = np.nanmean(pointwise_error_GLOB, axis=0)
+            (
+                stdD_error_real_history,
+                stdD_error_fake_history,
+                stdG_error_history,
+            ) = np.nanstd(pointwise_error_GLOB, axis=0)
+
             plt.figure()
             plt.plot(
                 [x for x in range(0, len(averageD_error_real_history))],
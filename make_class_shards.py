@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Write the training set as one contiguous uint8 shard per class, so that each
+MPI rank of main_GANs.py (--shard_dir) only reads the samples of its label.
+With the tar format, the image files of an ImageFolder directory are instead
+packed in tar files of a single class, streamed sequentially by main_GANs.py
+(--imagenet_tar_dir).
+The classes are split among the MPI ranks running this script.
+
+Usage:
+  make_class_shards.py (-h | --help)
+  make_class_shards.py [-d DATASET] [-o OUTPUT_DIR] [-f FORMAT] [--image_root=<str>] [--images_per_tar=<n>]
+
+Options:
+  -h, --help                  Show this screen.
+  -d, --dataset=<str>         Dataset to convert. MNIST, CIFAR10, CIFAR100, IMAGENET1K [default: CIFAR10]
+  -o, --output_dir=<str>      Directory of the class shards [default: ./dataset_shards]
+  -f, --format=<str>          Format of the shards. npy (decoded images) or tar (image files, IMAGENET1K only) [default: npy]
+  --image_root=<str>          ImageFolder directory packed in tar files. Defaults to the IMAGENET1K training directory.
+  --images_per_tar=<n>        Maximum number of images in a tar file [default: 1000].
+"""
+
+from docopt import docopt
+import mpi4py
+
+mpi4py.rc.initialize = False
+mpi4py.rc.finalize = False
+from mpi4py import MPI
+
+from Dataloader import *
+
+MPI.Init()
+
+if __name__ == '__main__':
+    args = docopt(__doc__)
+
+    if args['--format'] == 'npy':
+        write_class_shards(args['--dataset'], args['--output_dir'])
+        output_dir = os.path.dirname(
+            class_shard_path(args['--output_dir'], args['--dataset'], 0)
+        )
+    elif args['--format'] == 'tar':
+        if args['--dataset'] != 'IMAGENET1K':
+            raise RuntimeError('tar shards are only written for IMAGENET1K')
+        image_root = args['--image_root']
+        if image_root is None:
+            image_root = os.path.join(imagenet_path, "train")
+        write_tar_shards(
+            image_root, args['--output_dir'], int(args['--images_per_tar'])
+        )
+        output_dir = args['--output_dir']
+    else:
+        raise RuntimeError('Shard format not recognized')
+
+    if MPI.COMM_WORLD.Get_rank() == 0:
+        print('Class shards written in ' + output_dir)
+
+MPI.Finalize()
@@ -17,6 +17,7 @@ GaussSeidel: GaussSeidel variation of the algorithm
 Newton: Same algorithm but with pure essian term not set to identity
 '''
 
+import copy
 import time
 import torch
 import numpy
@@ -49,10 +50,62 @@ class Optimizer(object, metaclass=ABCMeta):
             self.conditional = True
         else:
             self.conditional = False
+        # ranks training the same models on shards of the data, if any
+        self.comm = None
+        # conjugate gradient solves started from the previous solution of
+        # the same system, and iterations of every solve
+        self.warm_start = False
+        self.cg_solutions = {}
+        self.cg_iterations = []
+        # name of the preconditioner of the conjugate gradient solves, in
+        # utils.preconditioners, and its instance for each system
+        self.preconditioner = None
+        self.cg_preconditioners = {}
+        # CGPolicy terminating the conjugate gradient solves, copied for
+        # each system
+        self.policy = None
+        self.cg_policies = {}
 
     def zero_grad(self):
-        zero_grad(self.G.parameters())
-        zero_grad(self.D.parameters())
+        self.G.flat_grad.zero_()
+        self.D.flat_grad.zero_()
+
+    def average(self, tensors):
+        allreduce_mean(tensors, self.comm)
+
+    def average_gradients(self, model):
+        self.average([model.flat_grad])
+
+    def initial_guess(self, system, b):
+        # previous solution of the system, rescaled to the norm of the new
+        # right-hand side b
+        if not self.warm_start or system not in self.cg_solutions:
+            return None
+        x, b_norm = self.cg_solutions[system]
+        if b_norm == 0:
+            return None
+        return x.mul(b.norm() / b_norm)
+
+    def cg_preconditioner(self, system):
+        if self.preconditioner is None:
+            return None
+        if system not in self.cg_preconditioners:
+            self.cg_preconditioners[system] = preconditioners[
+                self.preconditioner
+            ]()
+        return self.cg_preconditioners[system]
+
+    def cg_policy(self, system):
+        if self.policy is None:
+            return None
+        if system not in self.cg_policies:
+            self.cg_policies[system] = copy.copy(self.policy)
+        return self.cg_policies[system]
+
+    def keep_solution(self, system, b, x, iterations):
+        self.cg_iterations.append(iterations)
+        if self.warm_start:
+            self.cg_solutions[system] = (x.detach().clone(), b.norm())
 
     @abstractmethod
     def step(self, real_data, N):
@@ -117,13 +170,16 @@ class CGD(Optimizer):
             x_params=self.G.parameters(),
             y_params=self.D.parameters(),
             kk=p_x,
-            x=None,
+            x=self.initial_guess('x', p_x),
             nsteps=p_x.shape[0],
             lr_x=self.lr,
             lr_y=self.lr,
             device_x=self.G.device,
             device_y=self.D.device,
+            preconditioner=self.cg_preconditioner('x'),
+            policy=self.cg_policy('x'),
         )
+        self.keep_solution('x', p_x, cg_x, iter_num)
 
         # cg_x.detach_().mul_(p_x_norm)
         # cg_x.detach_().mul_(p_x_norm)
@@ -249,7 +305,10 @@ class CGD_shafer(Optimizer):
                 nsteps=p_y.shape[0] // 10000,
                 lr_x=lr_y,
                 lr_y=lr_x,
+                preconditioner=self.cg_preconditioner('y'),
+                policy=self.cg_policy('y'),
             )
+            self.cg_iterations.append(self.iter_num)
             # cg_y.mul_(p_y_norm)
             cg_y.detach_().mul_(-lr_y.sqrt())
             hcg = (
@@ -276,7 +335,10 @@ class CGD_shafer(Optimizer):
                 nsteps=p_x.shape[0] // 10000,
                 lr_x=lr_x,
                 lr_y=lr_y,
+                preconditioner=self.cg_preconditioner('x'),
+                policy=self.cg_policy('x'),
             )
+            self.cg_iterations.append(self.iter_num)
             # cg_x.detach_().mul_(p_x_norm)
             cg_x.detach_().mul_(lr_x.sqrt())  # delta x = lr_x.sqrt() * cg_x
             hcg = (
@@ -415,13 +477,9 @@ class GaussSeidel(Optimizer):
         ).detach_()  # grad_x + 2 * D_xy *  grad_y
 
         p_x = p_x.mul_(self.lr_x.sqrt().to(self.G.device))
+        self.average([p_x])
 
-        index = 0
-        for p in self.G.parameters():
-            p.data.add_(p_x[index : index + p.numel()].reshape(p.shape))
-            index += p.numel()
-        if index != p_x.numel():
-            raise RuntimeError('CG size mismatch')
+        self.G.flat_parameters.add_(p_x)
 
         # Second argument of noise is the noise_dimension parameter of build_generator
         fake_data = self.G(noise(N, 100).to(self.G.device))
@@ -451,13 +509,9 @@ class GaussSeidel(Optimizer):
         ).detach_()  # grad_y +2 * D_yx * x
         # p_x = torch.add(grad_x_vec, 2*hvp_x_vec).detach_()  # grad_x +2 * D_xy * y
         p_y = p_y.mul_(self.lr_y.sqrt().to(self.D.device))
+        self.average([p_y])
 
-        index = 0
-        for p in self.D.parameters():
-            p.data.add_(p_y[index : index + p.numel()].reshape(p.shape))
-            index += p.numel()
-        if index != p_y.numel():
-            raise RuntimeError('CG size mismatch')
+        self.D.flat_parameters.add_(p_y)
         return error_real.item(), error_fake.item(), g_error.item()
 
 
@@ -548,7 +602,7 @@ class Newton(Optimizer):
             -grad_y_vec, -2 * hvp_y_vec
         ).detach_()  # grad_y + 2 * D_yx * grad_x
 
-        p_x = general_conjugate_gradient_jacobi(
+        p_x, iterations_x = general_conjugate_gradient_jacobi(
             grad_x_vec,
             self.G.parameters(),
             right_side_x,
@@ -556,8 +610,9 @@ class Newton(Optimizer):
             nsteps=1000,
             residual_tol=1e-16,
             device=self.G.device,
+            policy=self.cg_policy('x'),
         )
-        p_y = general_conjugate_gradient_jacobi(
+        p_y, iterations_y = general_conjugate_gradient_jacobi(
             grad_y_vec,
             self.D.parameters(),
             right_side_y,
@@ -565,9 +620,9 @@ class Newton(Optimizer):
             nsteps=1000,
             residual_tol=1e-16,
             device=self.D.device,
+            policy=self.cg_policy('y'),
         )
-        p_x = p_x[0]
-        p_y = p_y[0]
+        self.cg_iterations.extend([iterations_x, iterations_y])
 
         p_x = p_x.mul_(self.lr_x.sqrt().to(self.G.device))
         p_y = p_y.mul_(self.lr_y.sqrt().to(self.D.device))
@@ -672,7 +727,7 @@ class Adam(Optimizer):
     def step(self, real_data, labels, N):
         if self.conditional == True:
             # Generator step
-            self.optimizer_G.zero_grad()
+            self.optimizer_G.zero_grad(set_to_none=False)
             # Second argument of noise is the noise_dimension parameter of build_generator
 
             fake_labels = Variable(
@@ -690,9 +745,10 @@ class Adam(Optimizer):
             )
 
             g_error.backward()
+            self.average_gradients(self.G)
             self.optimizer_G.step()
             # Discriminator step
-            self.optimizer_D.zero_grad()
+            self.optimizer_D.zero_grad(set_to_none=False)
             # Measure discriminator's ability to classify real from generated samples
             d_pred_real = self.D(
                 real_data.to(self.D.device), labels.to(self.D.device)
@@ -710,12 +766,13 @@ class Adam(Optimizer):
 
             d_loss = (error_real + error_fake) / 2
             d_loss.backward()
+            self.average_gradients(self.D)
             self.optimizer_D.step()
 
             return error_real.item(), error_fake.item(), g_error.item()
         else:
             # Generator step
-            self.optimizer_G.zero_grad()
+            self.optimizer_G.zero_grad(set_to_none=False)
             # Second argument of noise is the noise_dimension parameter of build_generator
             fake_data = self.G(noise(N, self.noise_dim).to(self.G.device))
             d_pred_fake = self.D(fake_data.to(self.D.device))
@@ -725,9 +782,10 @@ class Adam(Optimizer):
             )
 
             g_error.backward()
+            self.average_gradients(self.G)
             self.optimizer_G.step()
             # Discriminator step
-            self.optimizer_D.zero_grad()
+            self.optimizer_D.zero_grad(set_to_none=False)
             # Measure discriminator's ability to classify real from generated samples
             d_pred_real = self.D(real_data.to(self.D.device))
             error_real = self.criterion(
@@ -740,6 +798,7 @@ class Adam(Optimizer):
 
             d_loss = (error_real + error_fake) / 2
             d_loss.backward()
+            self.average_gradients(self.D)
             self.optimizer_D.step()
 
             return error_real.item(), error_fake.item(), g_error.item()
@@ -817,11 +876,14 @@ class CGDMultiCost(Optimizer):
             x_params=self.G.parameters(),
             y_params=self.D.parameters(),
             kk=p_x,
-            x=None,
+            x=self.initial_guess('x', p_x),
             nsteps=p_x.shape[0],
             lr_x=self.lr_x,
             lr_y=self.lr_y,
+            preconditioner=self.cg_preconditioner('x'),
+            policy=self.cg_policy('x'),
         )
+        self.keep_solution('x', p_x, cg_x, iter_num)
 
         cg_x.detach_().mul_(-self.lr_y.sqrt())  # Necessario ?
 
@@ -832,11 +894,14 @@ class CGDMultiCost(Optimizer):
             x_params=self.D.parameters(),
             y_params=self.G.parameters(),
             kk=p_y,
-            x=None,
+            x=self.initial_guess('y', p_y),
             nsteps=p_y.shape[0],
             lr_x=self.lr_x,
             lr_y=self.lr_y,
+            preconditioner=self.cg_preconditioner('y'),
+            policy=self.cg_policy('y'),
         )
+        self.keep_solution('y', p_y, cg_y, iter_num)
 
         cg_y.detach_().mul_(-self.lr_y.sqrt())  # moltiplicare per -lr o +lr
 
@@ -876,7 +941,7 @@ class Adam_torch(Optimizer):
     def step(self, real_data, labels, N):
         if self.conditional == True:
             # Generator step
-            self.optimizer_G.zero_grad()
+            self.optimizer_G.zero_grad(set_to_none=False)
             # Second argument of noise is the noise_dimension parameter of build_generator
             # noise = torch.randn(N, 100, 1, 1).to(self.G.device)
             # fake_labels = Variable(
@@ -899,9 +964,10 @@ class Adam_torch(Optimizer):
             )
 
             g_error.backward()
+            self.average_gradients(self.G)
             self.optimizer_G.step()
             # Discriminator step
-            self.optimizer_D.zero_grad()
+            self.optimizer_D.zero_grad(set_to_none=False)
             # Measure discriminator's ability to classify real from generated samples
             d_pred_real = self.D(
                 real_data.to(self.D.device), labels.to(self.D.device)
@@ -918,12 +984,13 @@ class Adam_torch(Optimizer):
 
             d_loss = (error_real + error_fake) / 2
             d_loss.backward()
+            self.average_gradients(self.D)
             self.optimizer_D.step()
 
             return error_real.item(), error_fake.item(), g_error.item()
         else:
             # Generator step
-            self.optimizer_G.zero_grad()
+            self.optimizer_G.zero_grad(set_to_none=False)
             noise = torch.randn(N, 100, 1, 1).to(self.G.device)
             # Second argument of noise is the noise_dimension parameter of build_generator
             fake_data = self.G(noise)
@@ -934,9 +1001,10 @@ class Adam_torch(Optimizer):
             g_error = self.criterion(d_pred_fake.to(self.G.device), label_1)
 
             g_error.backward()
+            self.average_gradients(self.G)
             self.optimizer_G.step()
             # Discriminator step
-            self.optimizer_D.zero_grad()
+            self.optimizer_D.zero_grad(set_to_none=False)
             # Measure discriminator's ability to classify real from generated samples
             d_pred_real = self.D(real_data.to(self.D.device)).view(-1)
             label_1 = torch.full((N,), 1.0, dtype=torch.float).to(
@@ -951,6 +1019,7 @@ class Adam_torch(Optimizer):
 
             d_loss = (error_real + error_fake) / 2
             d_loss.backward()
+            self.average_gradients(self.D)
             self.optimizer_D.step()
 
             return error_real.item(), error_fake.item(), g_error.item()
@@ -0,0 +1,77 @@
+'''
+Assignment of the labels of a dataset to the MPI ranks, when each rank
+trains the generator/discriminator pairs of one or more labels.
+'''
+##########################################
+
+import numpy as np
+from mpi4py import MPI
+
+
+def balance_labels(label_steps, step_times):
+    '''
+    Longest processing time first assignment of the labels to the ranks:
+    the labels are taken from the longest to the shortest, and each one is
+    given to the rank on which it would finish first.
+    label_steps[label] is the number of training steps of a label and
+    step_times[rank] the time of a step on a rank. Returns the labels of
+    each rank and the predicted finish time of each rank.
+    '''
+    rank_labels = [[] for _ in step_times]
+    finish_times = [0.0 for _ in step_times]
+    for label in sorted(
+        range(len(label_steps)), key=lambda label: -label_steps[label]
+    ):
+        rank = min(
+            range(len(step_times)),
+            key=lambda rank: finish_times[rank]
+            + label_steps[label] * step_times[rank],
+        )
+        rank_labels[rank].append(label)
+        finish_times[rank] += label_steps[label] * step_times[rank]
+    return rank_labels, finish_times
+
+
+class LabelQueue(object):
+    '''
+    Labels handed out in order to the groups of ranks as they ask for them.
+    The position of the next label is a counter in an MPI window of rank 0
+    of comm, taken and incremented with a one-sided Fetch_and_op, so that
+    no rank waits for the others or for a scheduler. The first rank of each
+    group of label_comm takes the labels of its group.
+    Created and freed by all the ranks of comm.
+    '''
+
+    def __init__(self, labels, label_comm=None, comm=MPI.COMM_WORLD):
+        self.labels = list(labels)
+        self.label_comm = label_comm
+        self.comm = comm
+        item_size = MPI.INT64_T.Get_size()
+        self.window = MPI.Win.Allocate(
+            item_size if comm.Get_rank() == 0 else 0, item_size, comm=comm
+        )
+        if comm.Get_rank() == 0:
+            self.window.Lock(0)
+            self.window.Put(np.zeros(1, dtype=np.int64), 0)
+            self.window.Unlock(0)
+        comm.Barrier()
+
+    def take(self, count=1):
+        '''
+        Next labels of the group, at most count of them, and none once all
+        the labels were handed out. Called by all the ranks of the group.
+        '''
+        start = None
+        if self.label_comm is None or self.label_comm.Get_rank() == 0:
+            increment = np.array([count], dtype=np.int64)
+            position = np.empty(1, dtype=np.int64)
+            self.window.Lock(0, MPI.LOCK_SHARED)
+            self.window.Fetch_and_op(increment, position, 0, op=MPI.SUM)
+            self.window.Unlock(0)
+            start = int(position[0])
+        if self.label_comm is not None:
+            start = self.label_comm.bcast(start, root=0)
+        return self.labels[start : start + count]
+
+    def free(self):
+        self.window.Free()
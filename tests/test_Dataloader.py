@@ -0,0 +1,34 @@
+import os
+import sys
+
+import numpy as np
+import PIL.Image as pil
+import torch
+from torchvision import transforms
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from Dataloader import TarShardDataset, write_tar_shards
+
+
+def test_tar_stream_first_batch_mixes_classes(tmp_path):
+    # one tar file per shuffle buffer of images of each class, as written by
+    # make_class_shards.py with its defaults
+    n_classes, images_per_class, images_per_tar = 4, 24, 12
+    image_root = tmp_path / 'images'
+    for label in range(n_classes):
+        os.makedirs(image_root / 'class_{}'.format(label))
+        for number in range(images_per_class):
+            pil.fromarray(np.full((8, 8, 3), label, dtype=np.uint8)).save(
+                image_root / 'class_{}'.format(label) / '{}.png'.format(number)
+            )
+    tar_dir = str(tmp_path / 'tars')
+    write_tar_shards(str(image_root), tar_dir, images_per_tar=images_per_tar)
+
+    data = TarShardDataset(
+        tar_dir, transforms.PILToTensor(), shuffle_buffer=images_per_tar
+    )
+    _, labels = next(
+        iter(torch.utils.data.DataLoader(data, batch_size=images_per_tar))
+    )
+    assert len(torch.unique(labels)) == n_classes
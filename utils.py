@@ -9,12 +9,14 @@
 '''
 ##########################################
 import os
+import time
 import numpy as np
 from matplotlib import pyplot as plt
 import torch
 from torch import autograd
 from torch import nn
 from torch.autograd.variable import Variable
+from torch.utils.weak import WeakIdKeyDictionary
 from mpi4py import MPI
 
 if torch.cuda.is_available():
@@ -155,9 +157,190 @@ def get_gpu(number):
     return device
 
 
+_node_comm = None
+
+
+def get_node_comm():
+    '''
+    Communicator of the MPI ranks that share the memory of this node
+    '''
+    global _node_comm
+    if _node_comm is None:
+        _node_comm = MPI.COMM_WORLD.Split_type(MPI.COMM_TYPE_SHARED)
+    return _node_comm
+
+
+def cores_per_rank():
+    '''
+    CPU cores of the node divided among the MPI ranks running on it, and
+    limited to the cores this rank is bound to
+    '''
+    cores = os.cpu_count() // get_node_comm().Get_size()
+    if hasattr(os, 'sched_getaffinity'):
+        cores = min(cores, len(os.sched_getaffinity(0)))
+    return max(cores, 1)
+
+
+def allreduce_mean(tensors, comm):
+    '''
+    Average the tensors in place over the ranks of the communicator, with a
+    single allreduce of their concatenation
+    '''
+    if comm is None or comm.Get_size() == 1 or len(tensors) == 0:
+        return
+    flat = torch.cat([t.detach().reshape(-1).cpu() for t in tensors])
+    buffer = flat.numpy()
+    comm.Allreduce(MPI.IN_PLACE, buffer, op=MPI.SUM)
+    flat.div_(comm.Get_size())
+    index = 0
+    for t in tensors:
+        t.detach().copy_(flat[index : index + t.numel()].view_as(t))
+        index += t.numel()
+
+
+def broadcast_parameters(modules, comm, root=0):
+    '''
+    Copy the parameters and buffers of the modules of the root rank to the
+    other ranks of the communicator
+    '''
+    if comm is None or comm.Get_size() == 1:
+        return
+    tensors = [
+        t
+        for module in modules
+        for t in list(module.parameters()) + list(module.buffers())
+        if t.is_floating_point()
+    ]
+    flat = torch.cat([t.detach().reshape(-1).cpu() for t in tensors])
+    comm.Bcast(flat.numpy(), root=root)
+    index = 0
+    for t in tensors:
+        t.detach().copy_(flat[index : index + t.numel()].view_as(t))
+        index += t.numel()
+
+
+class AsyncMetrics(object):
+    '''
+    Training metrics of each rank gathered on the root rank with
+    non-blocking Igather on a duplicate of the communicator, so that no rank
+    waits for the others during training. The metrics are posted every
+    interval steps, the posts are completed on later steps, and the root
+    prints the global progress of each completed post.
+    All the ranks must post the same number of times: close() pads the
+    posts of the ranks that trained fewer steps with NaN metrics.
+    '''
+
+    def __init__(self, interval, comm=MPI.COMM_WORLD, root=0):
+        self.parent_comm = comm
+        self.comm = comm.Dup()
+        self.root = root
+        self.interval = interval
+        self.steps = 0
+        self.images = 0
+        self.start = time.time()
+        self.posts = 0
+        self.pending = []
+
+    def step(self, images, epoch, error_real, error_fake, g_error):
+        '''
+        Count a training step of the given number of images, and post the
+        metrics of this rank every interval steps
+        '''
+        self.steps += 1
+        self.images += images
+        if self.steps % self.interval == 0:
+            now = time.time()
+            self.post(
+                [
+                    epoch,
+                    error_real,
+                    error_fake,
+                    g_error,
+                    self.images / (now - self.start),
+                ]
+            )
+            self.images = 0
+            self.start = now
+        self.complete()
+
+    def post(self, metrics):
+        send = np.array([float(value) for value in metrics])
+        recv = None
+        if self.comm.Get_rank() == self.root:
+            recv = np.empty((self.comm.Get_size(), send.size))
+        request = self.comm.Igather(send, recv, root=self.root)
+        # the buffers are kept until the gather is completed
+        self.pending.append((self.posts, request, send, recv))
+        self.posts += 1
+
+    def complete(self, wait=False):
+        '''
+        Complete the posts in order, without waiting unless wait is True,
+        and print the global metrics of the completed posts on the root
+        '''
+        while self.pending:
+            post, request, _, recv = self.pending[0]
+            if wait:
+                request.Wait()
+            elif not request.Test():
+                break
+            self.pending.pop(0)
+            if recv is not None:
+                self.report(post, recv)
+
+    def report(self, post, metrics):
+        ranks = metrics[~np.isnan(metrics[:, 0])]
+        if len(ranks) == 0:
+            return
+        print(
+            'Progress {}: {} ranks, epochs {:.0f}-{:.0f},'.format(
+                post + 1, len(ranks), ranks[:, 0].min(), ranks[:, 0].max()
+            ),
+            'mean errors D real {:.5e} D fake {:.5e} G {:.5e},'.format(
+                *ranks[:, 1:4].mean(axis=0)
+            ),
+            '{:.1f} images/s'.format(ranks[:, 4].sum()),
+        )
+
+    def close(self):
+        '''
+        Pad the posts to the number of posts of the other ranks, and
+        complete them. The number of posts is agreed on the parent
+        communicator, as the other ranks may still be posting on self.comm.
+        '''
+        posts = self.parent_comm.allreduce(self.posts, op=MPI.MAX)
+        while self.posts < posts:
+            self.post([np.nan] * 5)
+        self.complete(wait=True)
+        self.comm.Free()
+
+
 #############################################################################
 
 
+def flatten_parameters(module):
+    '''
+    Store the parameters of a module, and their gradients, in one contiguous
+    buffer each, module.flat_parameters and module.flat_grad, of which the
+    parameters and gradients become views. The flat vectors of the
+    parameters and gradients are then read and updated in place without
+    copies. The gradients must be zeroed, not set to None, and the module
+    must not be moved to another device afterwards.
+    '''
+    params = list(module.parameters())
+    if len(params) == 0:
+        return
+    flat = torch.cat([p.detach().reshape(-1) for p in params])
+    grad = torch.zeros_like(flat)
+    index = 0
+    for p in params:
+        p.data = flat[index : index + p.numel()].view_as(p)
+        p.grad = grad[index : index + p.numel()].view_as(p)
+        index += p.numel()
+    module.flat_parameters = flat
+    module.flat_grad = grad
+
+
 def zero_grad(params):
     for p in params:
         if p.grad is not None:
@@ -174,39 +357,47 @@ def weights_init_normal(m):
         torch.nn.init.constant_(m.bias.data, 0.0)
 
 
+# flat zero slices of the Hessian-vector products, for the parameters that
+# do not appear in the graph of a gradient
+_hvp_zeros = WeakIdKeyDictionary()
+
+
+def zero_slice(p):
+    if p not in _hvp_zeros:
+        _hvp_zeros[p] = torch.zeros(p.numel(), dtype=p.dtype, device=p.device)
+    return _hvp_zeros[p]
+
+
 def Hvp_vec(grad_vec, params, vec, retain_graph=False):
+    '''
+    Product of the derivative of grad_vec with respect to params by vec, as a
+    flat vector, in a single double-backward pass. The parameters that
+    grad_vec does not depend on, such as the embeddings of the conditional
+    models, give zero slices.
+    '''
     if torch.isnan(grad_vec).any():
         print('grad vec nan')
         raise ValueError('grad Nan')
     if torch.isnan(vec).any():
         print('vec nan')
         raise ValueError('vec Nan')
-    try:
-        grad_grad = autograd.grad(
-            grad_vec, params, grad_outputs=vec, retain_graph=retain_graph
-        )
-        hvp = torch.cat([g.contiguous().view(-1) for g in grad_grad])
-        if torch.isnan(hvp).any():
-            print('hvp nan')
-            raise ValueError('hvp Nan')
-    except:
-        # print('filling zero for None')
-        grad_grad = autograd.grad(
-            grad_vec,
-            params,
-            grad_outputs=vec,
-            retain_graph=retain_graph,
-            allow_unused=True,
-        )
-        grad_list = []
-        for i, p in enumerate(params):
-            if grad_grad[i] is None:
-                grad_list.append(torch.zeros_like(p))
-            else:
-                grad_list.append(grad_grad[i].contiguous().view(-1))
-        hvp = torch.cat(grad_list)
-        if torch.isnan(hvp).any():
-            raise ValueError('hvp Nan')
+    params = tuple(params)
+    grad_grad = autograd.grad(
+        grad_vec,
+        params,
+        grad_outputs=vec,
+        retain_graph=retain_graph,
+        allow_unused=True,
+    )
+    hvp = torch.cat(
+        [
+            zero_slice(p) if g is None else g.contiguous().view(-1)
+            for g, p in zip(grad_grad, params)
+        ]
+    )
+    if torch.isnan(hvp).any():
+        print('hvp nan')
+        raise ValueError('hvp Nan')
     return hvp
 
 
@@ -284,6 +475,127 @@ class Richardson(object):
         return solution
 
 
+class HutchinsonPreconditioner(object):
+    '''
+    Jacobi preconditioner of general_conjugate_gradient: inverse of the
+    diagonal of the system matrix A, estimated as the mean of v * A v over
+    random +-1 vectors v (Hutchinson). Each probe costs one product by A, so
+    the estimate is refreshed every interval solves only.
+    '''
+
+    def __init__(self, probes=4, interval=10):
+        self.probes = probes
+        self.interval = interval
+        self.solves = 0
+        self.diagonal = None
+
+    def setup(self, Avp, grad_x, grad_y, lr_x, lr_y):
+        if self.solves % self.interval == 0:
+            diagonal = torch.zeros_like(grad_x).detach()
+            for _ in range(self.probes):
+                v = torch.randint_like(diagonal, 2).mul_(2).sub_(1)
+                diagonal.add_(v * Avp(v))
+            # A is the identity plus a positive semi-definite matrix
+            self.diagonal = diagonal.div_(self.probes).clamp_(min=1.0)
+        self.solves += 1
+
+    def __call__(self, r):
+        return r / self.diagonal
+
+
+class SquareAvgPreconditioner(object):
+    '''
+    Jacobi preconditioner of general_conjugate_gradient from the running
+    averages of the squared gradients, the square_avg of RMSprop. With the
+    mixed derivatives approximated by the outer product of the gradients,
+    D_xy ~ grad_x * grad_y^T, the diagonal of the system matrix is
+    1 + lr_x * grad_x^2 * sum(lr_y * grad_y^2), at no Hessian-vector product.
+    '''
+
+    def __init__(self, beta2=0.99):
+        self.beta2 = beta2
+        self.count = 0
+        self.square_avg_x = None
+        self.square_avg_y = None
+        self.diagonal = None
+
+    def setup(self, Avp, grad_x, grad_y, lr_x, lr_y):
+        grad_x = grad_x.detach()
+        grad_y = grad_y.detach()
+        if self.square_avg_x is None:
+            self.square_avg_x = torch.zeros_like(grad_x)
+            self.square_avg_y = torch.zeros_like(grad_y)
+        self.count += 1
+        self.square_avg_x.mul_(self.beta2).addcmul_(
+            grad_x, grad_x, value=1 - self.beta2
+        )
+        self.square_avg_y.mul_(self.beta2).addcmul_(
+            grad_y, grad_y, value=1 - self.beta2
+        )
+        # initialization bias correction
+        bias_correction = 1 - self.beta2 ** self.count
+        square_y = (lr_y.to(grad_y.device) * self.square_avg_y).sum()
+        self.diagonal = (
+            lr_x.to(grad_x.device)
+            * self.square_avg_x
+            * square_y.to(grad_x.device)
+            / bias_correction ** 2
+        ).add_(1.0)
+
+    def __call__(self, r):
+        return r / self.diagonal
+
+
+class CGPolicy(object):
+    '''
+    Termination of the solves of general_conjugate_gradient: a solve stops
+    once the norm of the residual is below rtol times the norm of the
+    right-hand side, after max_iter iterations (the nsteps of the caller if
+    None), or after time_budget seconds (no limit if None).
+    With forcing terms, as in inexact Newton methods, the relative tolerance
+    of a solve is forcing times the norm of its right-hand side relative to
+    the first solve, within [rtol, forcing]: loose while the gradients are
+    large and tighter as they decrease.
+    '''
+
+    def __init__(
+        self, rtol=1e-8, max_iter=None, time_budget=None, forcing=None
+    ):
+        self.rtol = rtol
+        self.max_iter = max_iter
+        self.time_budget = time_budget
+        self.forcing = forcing
+        self.initial_norm = None
+        self.deadline = None
+
+    def start(self, b_norm, nsteps):
+        '''
+        Relative tolerance and maximum number of iterations of a solve with
+        a right-hand side of norm b_norm, starting its time budget
+        '''
+        rtol = self.rtol
+        if self.forcing is not None:
+            if self.initial_norm is None:
+                self.initial_norm = b_norm
+            if self.initial_norm > 0:
+                rtol = self.forcing * b_norm / self.initial_norm
+            rtol = min(max(rtol, self.rtol), self.forcing)
+        if self.time_budget is not None:
+            self.deadline = time.perf_counter() + self.time_budget
+        return rtol, nsteps if self.max_iter is None else self.max_iter
+
+    def expired(self):
+        return (
+            self.deadline is not None and time.perf_counter() > self.deadline
+        )
+
+
+preconditioners = {
+    'hutchinson': HutchinsonPreconditioner,
+    'square_avg': SquareAvgPreconditioner,
+}
+
+
 def general_conjugate_gradient(
     grad_x,
     grad_y,
@@ -297,6 +609,8 @@ def general_conjugate_gradient(
     residual_tol=1e-16,
     device_x=torch.device('cpu'),
     device_y=torch.device('cpu'),
+    preconditioner=None,
+    policy=None,
 ):
     '''
 
@@ -312,25 +626,23 @@ def general_conjugate_gradient(
     :param residual_tol:
     :param device:
     :return: (I + sqrt(lr_x) * D_xy * lr_y * D_yx * sqrt(lr_x)) ** -1 * b
+        and the number of iterations. With an initial guess x, the iterations
+        start from the residual b - A * x, and the tolerance stays relative
+        to b. With a preconditioner, such as HutchinsonPreconditioner, the
+        iterations are those of the preconditioned conjugate gradient. With
+        a CGPolicy, the tolerance and maximum number of iterations are those
+        of the policy instead of residual_tol and nsteps.
 
     '''
-    if x is None:
-        x = torch.zeros(kk.shape[0], device=device_x)
     if grad_x.shape != kk.shape:
         raise RuntimeError('CG: hessian vector product shape mismatch')
+    system_lr = (lr_x, lr_y)
     lr_x = lr_x.sqrt().to(device_x)
     lr_y = lr_y.to(device_y)
-
-    mm = kk.clone().detach()
-    mm = mm.to(device_x)
-    jj = mm.clone().detach()
-    jj = jj.to(device_x)
-    rdotr = torch.dot(mm, mm)
-    residual_tol = residual_tol * rdotr
     x_params = tuple(x_params)
     y_params = tuple(y_params)
-    for i in range(nsteps):
-        # To compute Avp
+
+    def Avp(jj):
         # h_1 = Hvp_vec(grad_vec=grad_x, params=y_params, vec=lr_x * p, retain_graph=True)
         h_1 = Hvp_vec(
             grad_vec=grad_x.to(device_x),
@@ -338,7 +650,6 @@ def general_conjugate_gradient(
             vec=lr_x * jj,
             retain_graph=True,
         ).mul_(lr_y)
-        # h_1.mul_(lr_y)
         # lr_y * D_yx * b
         # h_2 = Hvp_vec(grad_vec=grad_y, params=x_params, vec=lr_y * h_1, retain_graph=True)
         h_2 = Hvp_vec(
@@ -347,20 +658,51 @@ def general_conjugate_gradient(
             vec=h_1.to(device_x),
             retain_graph=True,
         ).mul_(lr_x)
-        # h_2.mul_(lr_x)
         # lr_x * D_xy * lr_y * D_yx * b
-        Avp_ = jj + h_2
+        return jj + h_2
 
-        alpha = rdotr / torch.dot(jj, Avp_)
+    mm = kk.clone().detach()
+    mm = mm.to(device_x)
+    if policy is None:
+        expired = lambda: False
+    else:
+        rtol, nsteps = policy.start(mm.norm().item(), nsteps)
+        residual_tol = rtol ** 2
+        expired = policy.expired
+    residual_tol = residual_tol * torch.dot(mm, mm)
+    if x is None:
+        x = torch.zeros(kk.shape[0], device=device_x)
+    else:
+        x = x.clone().detach().to(device_x)
+        mm.data.add_(-Avp(x))
+    if preconditioner is None:
+        preconditioner = lambda mm: mm
+    else:
+        preconditioner.setup(Avp, grad_x, grad_y, *system_lr)
+    zz = preconditioner(mm)
+    jj = zz.clone().detach()
+    rdotr = torch.dot(mm, mm)
+    rdotz = torch.dot(mm, zz)
+    iterations = 0
+    # at least one iteration within the time budget
+    while (
+        iterations < nsteps
+        and rdotr > residual_tol
+        and not (iterations > 0 and expired())
+    ):
+        Avp_ = Avp(jj)
+
+        alpha = rdotz / torch.dot(jj, Avp_)
         x.data.add_(alpha * jj)
         mm.data.add_(-alpha * Avp_)
-        new_rdotr = torch.dot(mm, mm)
-        beta = new_rdotr / rdotr
-        jj = mm + beta * jj
-        rdotr = new_rdotr
-        if rdotr < residual_tol:
-            break
-    return x, i + 1
+        rdotr = torch.dot(mm, mm)
+        zz = preconditioner(mm)
+        new_rdotz = torch.dot(mm, zz)
+        beta = new_rdotz / rdotz
+        jj = zz + beta * jj
+        rdotz = new_rdotz
+        iterations += 1
+    return x, iterations
 
 
 #######################################################################
@@ -372,6 +714,7 @@ def general_conjugate_gradient_jacobi(
     nsteps=10,
     residual_tol=1e-16,
     device=torch.device('cpu'),
+    policy=None,
 ):
     '''
 
@@ -383,7 +726,10 @@ def general_conjugate_gradient_jacobi(
     :param nsteps:
     :param residual_tol:
     :param device:
-    :return: (A) ** -1 * (right_side)
+    :param policy:
+    :return: (A) ** -1 * (right_side) and the number of iterations. With a
+        CGPolicy, the tolerance and maximum number of iterations are those
+        of the policy instead of residual_tol and nsteps.
 
     '''
     if x is None:
@@ -397,10 +743,18 @@ def general_conjugate_gradient_jacobi(
     right_side_clone2 = right_side_clone2.to(device)
 
     rdotr = torch.dot(right_side_clone1, right_side_clone1)
+    if policy is None:
+        expired = lambda: False
+    else:
+        rtol, nsteps = policy.start(rdotr.sqrt().item(), nsteps)
+        residual_tol = rtol ** 2
+        expired = policy.expired
     residual_tol = residual_tol * rdotr
     x_params = tuple(x_params)
 
-    for i in range(nsteps):
+    iterations = 0
+    # at least one iteration within the time budget
+    while iterations < nsteps and not (iterations > 0 and expired()):
         h_1 = Hvp_vec(
             grad_vec=grad_x.to(device),
             params=x_params,
@@ -417,9 +771,10 @@ def general_conjugate_gradient_jacobi(
         beta = new_rdotr / rdotr
         right_side_clone2 = right_side_clone1 + beta * right_side_clone2
         rdotr = new_rdotr
+        iterations += 1
         if rdotr < residual_tol:
             break
-    return x, i + 1
+    return x, iterations
 
 
 ###########################################